@@ -1,12 +1,20 @@
+import csv
+import io
 import re
+import sys
+import threading
+from datetime import datetime
 
 import psycopg2 as pg2
+from psycopg2 import errors as pg2_errors
 
+import chess_security
 import os_values
 import requests
 
 
 TABLE_NAME = 'accounts'
+GAMES_TABLE_NAME = 'games'
 
 USERNAME = 'username'
 PASSWORD = 'password_hash'
@@ -39,6 +47,23 @@ USER = 'user'
 BLOCKED = 'blocked'
 PERMISSIONS_LIST = [OWNER, ADMIN, USER, BLOCKED]
 COLUMNS_L = list(COLUMNS)
+RANK_USERNAME = f'{USERNAME} collate "C"'
+
+EMAIL_API_URL = "https://isitarealemail.com/api/email/validate"
+EMAIL_API_TIMEOUT = 3  # seconds
+MAX_EMAIL_CHECKS = 4  # requests to the validation api running at once
+VALID_EMAIL_TTL = 24 * 60 * 60
+INVALID_EMAIL_TTL = 60 * 60
+EMAIL_CACHE = chess_security.ExpiringTable(max_size=10000)  # email -> is valid
+EMAIL_CACHE_LOCK = threading.Lock()
+EMAIL_CHECKS = threading.BoundedSemaphore(MAX_EMAIL_CHECKS)
+
+IMPORT_BATCH_SIZE = 5000
+PAGE_SIZE = 50
+EXPORT_FORMATS = ['csv', 'binary']
+USERNAME_REGEX = re.compile(r'^[A-Za-z][A-Za-z\d]{2,31}$')
+EMAIL_REGEX = re.compile(r'^[\w.%+-]{1,64}@[A-Za-z\d.-]{1,253}\.[A-Z|a-z]{2,4}$')
+PASSWORD_HASH_REGEX = re.compile(r'^[\da-f]{128}$')
 
 ERROR = 0
 COMPLETE = 1
@@ -67,13 +92,23 @@ def get_constrains(column):
     return None
 
 
-def execute(code, return_cursor=False):
-    connection = os_values.DB_CONN
-    cursor = connection.cursor()
-    cursor.execute(code)
-    if return_cursor:
-        return cursor
-    cursor.close()
+FETCH_ONE = 'one'
+FETCH_ALL = 'all'
+
+
+def execute(code, params=None, fetch=None):
+    """
+    runs the code on a pooled connection. values are always passed in params (as %s
+    placeholders), only table and column names are formatted into the code.
+    Returns: the first row (fetch=FETCH_ONE), every row (fetch=FETCH_ALL) or None
+    """
+    with os_values.database_conn() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(code, params)
+            if fetch == FETCH_ONE:
+                return cursor.fetchone()
+            if fetch == FETCH_ALL:
+                return cursor.fetchall()
 
 
 def create_table():
@@ -86,10 +121,20 @@ def create_table():
             columns += f"({get_len(column)})"
         columns += f"{get_constrains(column)},\n"
     execute(f"create table if not exists {TABLE_NAME}({columns[:-2]});")
+    # the listings below page by these keys, username breaks ties so every key is unique
+    # ties of elo are ordered by username like the server's leaderboard (by code point, not the locale)
+    execute(f"create index if not exists {TABLE_NAME}_{ELO}_idx on {TABLE_NAME}({ELO} desc, {RANK_USERNAME});")
+    execute(f"create index if not exists {TABLE_NAME}_{LAST_ENTRY}_idx on {TABLE_NAME}({LAST_ENTRY} desc, {USERNAME} desc);")
+    execute(f"create index if not exists {TABLE_NAME}_{PERMISSIONS}_idx on {TABLE_NAME}({PERMISSIONS}, {USERNAME});")
+    # finished PvP games, the elo columns hold the ratings after the game
+    execute(f"create table if not exists {GAMES_TABLE_NAME}(id serial primary key, white varchar(32) not null, "
+            f"black varchar(32) not null, result varchar(7) not null, white_elo decimal not null, "
+            f"black_elo decimal not null, end_time timestamp not null default current_timestamp);")
 
 
 def drop_table():
     execute(f"drop table if exists {TABLE_NAME};")
+    execute(f"drop table if exists {GAMES_TABLE_NAME};")
 
 
 def reset_table():
@@ -99,22 +144,33 @@ def reset_table():
 
 def is_value_in_column(column, value):
     if column in COLUMNS:
-        cursor = execute(f"select * from {TABLE_NAME} where {column} = '{value}';", return_cursor=True)
-        data = cursor.fetchone()
-        cursor.close()
+        data = execute(f"select 1 from {TABLE_NAME} where {column} = %s limit 1;", (value,), FETCH_ONE)
         if data:
             return True
     return False
 
 
+def get_violated_column(error):
+    """
+    Returns: the column of the unique constraint a UniqueViolation was raised for
+    """
+    constraint = error.diag.constraint_name or ''
+    if constraint == f"{TABLE_NAME}_pkey":
+        return USERNAME
+    for column in COLUMNS:
+        if column in constraint:
+            return column
+    return None
+
+
 def delete_user(username):
-    if is_value_in_column(USERNAME, username):
-        execute(f"delete from {TABLE_NAME} where {USERNAME} = '{username}';")
+    data = execute(f"delete from {TABLE_NAME} where {USERNAME} = %s returning {USERNAME};", (username,), FETCH_ONE)
+    if data:
         return COMPLETE
     return INVALID_VALUE_ERROR
 
 
-def check_value(column, value):
+def check_value(column, value, check_unique=True):
     if column not in COLUMNS:
         return INVALID_COLUMN_ERROR
     if type(value) != str:
@@ -133,11 +189,11 @@ def check_value(column, value):
     if not value:
         if 'not null' in get_constrains(column):
             return INVALID_VALUE_ERROR
-    if 'unique' in get_constrains(column):
+    if check_unique and 'unique' in get_constrains(column):
         if is_value_in_column(column, value):
             return ALREADY_EXISTS_ERROR
     if column == ELO:
-        if not 0 < int(value) < 3500:
+        if not 0 < float(value) < 3500:
             return INVALID_VALUE_ERROR
     if column == PERMISSIONS:
         if value not in PERMISSIONS_LIST:
@@ -152,92 +208,381 @@ def insert_new_user(user_data):
     if len(user_data) > len(MANUALLY_MUTABLE_COLUMNS) or len(user_data) < len(MANUALLY_MUTABLE_COLUMNS):
         return ARGUMENTS_ERROR
     for column, value in dict(zip(MANUALLY_MUTABLE_COLUMNS, user_data)).items():
-        status = check_value(column, value)
+        # the unique columns are checked by the insert itself
+        status = check_value(column, value, check_unique=False)
         if status != VALID:
             return status, column
-    temp = []
-    x = 0
+    values = []
     for column in COLUMNS_L:
         if get_type(column) == 'timestamp':
-            temp.append('current_timestamp')
+            values.append('current_timestamp')
         else:
-            temp.append(f"'{user_data[x]}'")
-            x += 1
-    execute(f"insert into {TABLE_NAME}({', '.join(list(COLUMNS))}) values({', '.join(temp)});")
+            values.append('%s')
+    try:
+        execute(f"insert into {TABLE_NAME}({', '.join(COLUMNS_L)}) values({', '.join(values)});", tuple(user_data))
+    except pg2_errors.UniqueViolation as e:
+        return ALREADY_EXISTS_ERROR, get_violated_column(e)
     return COMPLETE, None
 
 
 def get_all_users():
     columns = COLUMNS_L.copy()
     columns.remove(PASSWORD)
-    cursor = execute(f"select {', '.join(columns)} from {TABLE_NAME};", return_cursor=True)
-    data = cursor.fetchall()
-    cursor.close()
-    return data
+    return execute(f"select {', '.join(columns)} from {TABLE_NAME};", fetch=FETCH_ALL)
+
+
+def get_all_ratings():
+    """
+    Returns: list of (username, elo) of every user
+    """
+    return execute(f"select {USERNAME}, {ELO} from {TABLE_NAME};", fetch=FETCH_ALL)
+
+
+def get_listed_columns():
+    return [column for column in COLUMNS_L if column != PASSWORD]
+
+
+def get_top_users(limit=PAGE_SIZE, after=None):
+    """
+    users by elo, highest first and ties by username (keyset pagination: a page costs the same
+    wherever it starts).
+    after: (elo, username) of the last row of the previous page
+    Returns: list of rows of get_listed_columns()
+    """
+    columns = ', '.join(get_listed_columns())
+    if after is None:
+        return execute(f"select {columns} from {TABLE_NAME} order by {ELO} desc, {RANK_USERNAME} limit %s;",
+                       (limit,), FETCH_ALL)
+    elo, username = after
+    # the directions differ so it can't be a row comparison, the first condition bounds the index scan
+    return execute(f"select {columns} from {TABLE_NAME} where {ELO} <= %s and ({ELO} < %s or {RANK_USERNAME} > %s) "
+                   f"order by {ELO} desc, {RANK_USERNAME} limit %s;", (elo, elo, username, limit), FETCH_ALL)
+
+
+def get_rank(username):
+    """
+    Returns: the user's place in get_top_users (1 is the highest elo), or None if there is no such user
+    """
+    data = execute(f"select (select count(*) from {TABLE_NAME} as other where other.{ELO} > player.{ELO} or "
+                   f"(other.{ELO} = player.{ELO} and other.{RANK_USERNAME} < player.{RANK_USERNAME})) + 1 "
+                   f"from {TABLE_NAME} as player where player.{USERNAME} = %s;", (username,), FETCH_ONE)
+    if data:
+        return data[0]
+    return None
+
+
+def get_recent_users(limit=PAGE_SIZE, after=None):
+    """
+    users by last entry, latest first.
+    after: (last entry, username) of the last row of the previous page
+    """
+    columns = ', '.join(get_listed_columns())
+    if after is None:
+        return execute(f"select {columns} from {TABLE_NAME} order by {LAST_ENTRY} desc, {USERNAME} desc limit %s;",
+                       (limit,), FETCH_ALL)
+    return execute(f"select {columns} from {TABLE_NAME} where ({LAST_ENTRY}, {USERNAME}) < (%s, %s) "
+                   f"order by {LAST_ENTRY} desc, {USERNAME} desc limit %s;", (*after, limit), FETCH_ALL)
+
+
+def get_users_by_permission(permission, limit=PAGE_SIZE, after=None):
+    """
+    users with the permission, by username.
+    after: username of the last row of the previous page
+    """
+    columns = ', '.join(get_listed_columns())
+    return execute(f"select {columns} from {TABLE_NAME} where {PERMISSIONS} = %s and {USERNAME} > %s "
+                   f"order by {USERNAME} limit %s;", (permission, after or '', limit), FETCH_ALL)
 
 
 def printable_table(table, columns):
-    table.insert(0, columns)
-    for i in range(len(table)):
-        table[i] = list(table[i])
-        for j in range(len(table[0])):
-            table[i][j] = str(table[i][j])
-    for i in range(len(table[0])):
-        longest = 0
-        for row in table:
-            if len(row[i]) > longest:
-                longest = len(row[i])
-        longest += 2
-        for j in range(len(table)):
-            table[j][i] += ' ' * (longest - len(table[j][i]))
-    data = ""
-    for line in table:
-        data += ' | '.join(line) + '\n'
-    return data[:-1]
+    rows = [[str(value) for value in row] for row in [columns] + list(table)]
+    widths = [max(len(row[i]) for row in rows) + 2 for i in range(len(columns))]
+    return '\n'.join(' | '.join(value.ljust(width) for value, width in zip(row, widths)) for row in rows)
+
+
+def export_users(file, columns=None, file_format='csv'):
+    """
+    streams the accounts into the file with COPY, the rows never pile up in memory. by default
+    only the columns import_users loads are written, so an export can be imported again.
+    file_format: 'csv' (with a header line, the file is opened in text mode) or 'binary'
+    (postgres' binary COPY format, the file is opened in binary mode)
+    """
+    if columns is None:
+        columns = MANUALLY_MUTABLE_COLUMNS
+    if file_format not in EXPORT_FORMATS or not all(column in COLUMNS for column in columns):
+        return ARGUMENTS_ERROR
+    header = ', header' if file_format == 'csv' else ''
+    with os_values.database_conn() as connection:
+        with connection.cursor() as cursor:
+            cursor.copy_expert(f"copy (select {', '.join(columns)} from {TABLE_NAME}) "
+                               f"to stdout with (format {file_format}{header});", file)
+    return COMPLETE
+
+
+def get_row_error(row):
+    """
+    the checks of check_value that don't need the database (or the email api).
+    Returns: the invalid column, or None if the row is valid
+    """
+    username, password, email, elo, games_played, permissions = row
+    if not USERNAME_REGEX.fullmatch(username):
+        return USERNAME
+    if not PASSWORD_HASH_REGEX.fullmatch(password):
+        return PASSWORD
+    if not EMAIL_REGEX.fullmatch(email):
+        return EMAIL
+    try:
+        if not 0 < float(elo) < 3500:
+            return ELO
+    except ValueError:
+        return ELO
+    if not games_played.isdecimal():
+        return GAMES_PLAYED
+    if permissions not in PERMISSIONS_LIST:
+        return PERMISSIONS
+    return None
+
+
+def validate_batch(batch):
+    """
+    batch: list of (line number, row). the rows are checked in memory, and the usernames and
+    emails of the whole batch are checked against the table (and each other) in one query.
+    Returns: the valid (line number, row) and a list of (line number, invalid column) of the
+    rejected ones
+    """
+    rejected = []
+    checked = []
+    for line, row in batch:
+        if len(row) != len(MANUALLY_MUTABLE_COLUMNS):
+            rejected.append((line, None))
+            continue
+        column = get_row_error(row)
+        if column:
+            rejected.append((line, column))
+        else:
+            checked.append((line, row))
+    usernames = [row[0] for line, row in checked]
+    emails = [row[2] for line, row in checked]
+    taken = execute(f"select {USERNAME}, {EMAIL} from {TABLE_NAME} where {USERNAME} = any(%s) or {EMAIL} = any(%s);",
+                    (usernames, emails), FETCH_ALL)
+    taken_usernames = {username for username, email in taken}
+    taken_emails = {email for username, email in taken}
+    valid = []
+    for line, row in checked:
+        if row[0] in taken_usernames:
+            rejected.append((line, USERNAME))
+        elif row[2] in taken_emails:
+            rejected.append((line, EMAIL))
+        else:
+            taken_usernames.add(row[0])
+            taken_emails.add(row[2])
+            valid.append((line, row))
+    return valid, rejected
+
+
+def copy_rows(rows):
+    now = datetime.now().isoformat(sep=' ')
+    data = io.StringIO()
+    writer = csv.writer(data)
+    for row in rows:
+        writer.writerow(list(row) + [now, now])
+    data.seek(0)
+    with os_values.database_conn() as connection:
+        with connection.cursor() as cursor:
+            cursor.copy_expert(f"copy {TABLE_NAME}({', '.join(MANUALLY_MUTABLE_COLUMNS + [LAST_ENTRY, CREATION_DATE])}) "
+                               f"from stdin with (format csv);", data)
+
+
+def import_users(file, batch_size=IMPORT_BATCH_SIZE):
+    """
+    loads accounts from a csv file with a header line and the columns of MANUALLY_MUTABLE_COLUMNS
+    (passwords already hashed), in batches that are validated together and written with COPY.
+    Returns: the number of imported accounts and a list of (line number, invalid column) of the
+    rejected rows
+    """
+    reader = csv.reader(file)
+    if next(reader, None) != MANUALLY_MUTABLE_COLUMNS:
+        return 0, [(1, None)]
+    imported = 0
+    rejected = []
+    batch = []
+    for line, row in enumerate(reader, 2):
+        batch.append((line, row))
+        if len(batch) == batch_size:
+            imported += import_batch(batch, rejected)
+            batch = []
+    if batch:
+        imported += import_batch(batch, rejected)
+    return imported, rejected
+
+
+def import_batch(batch, rejected):
+    valid, batch_rejected = validate_batch(batch)
+    rejected.extend(batch_rejected)
+    if not valid:
+        return 0
+    try:
+        copy_rows([row for line, row in valid])
+    except pg2_errors.UniqueViolation as e:
+        # an account was created meanwhile, the whole batch is rolled back
+        column = get_violated_column(e)
+        rejected.extend((line, column) for line, row in valid)
+        return 0
+    return len(valid)
+
+
+def check_email_api(email):
+    response = requests.get(EMAIL_API_URL, params={'email': email}, timeout=EMAIL_API_TIMEOUT)
+    return response.json()['status'] == "valid"
+
+
+EMAIL_VALIDATOR = check_email_api
+
+
+def set_email_validator(validator):
+    """
+    validator(email) returns whether the address exists, e.g. a local stand-in for the api.
+    """
+    global EMAIL_VALIDATOR
+    EMAIL_VALIDATOR = validator
+    with EMAIL_CACHE_LOCK:
+        EMAIL_CACHE.clear()
 
 
 def is_email_valid(email):
-    email_regex = r'^[\w.%+-]{1,64}@[A-Za-z\d.-]{1,253}\.[A-Z|a-z]{2,4}$'
-    if re.fullmatch(email_regex, email):
-        try:
-            response = requests.get("https://isitarealemail.com/api/email/validate", params={'email': email})
-            status = response.json()['status']
-            return status == "valid"
-        except:
-            return True
-    return False
+    """
+    the address has to look valid, and the validator's answer for it is cached.
+    the check fails open: when the validator is slow, down or no check slot frees up within
+    EMAIL_API_TIMEOUT, the address is accepted instead of holding the registration thread.
+    """
+    if not EMAIL_REGEX.fullmatch(email):
+        return False
+    key = email.lower()
+    with EMAIL_CACHE_LOCK:
+        valid = EMAIL_CACHE.get(key)
+    if valid is not None:
+        return valid
+    # during a burst of registrations a check waits for a slot, up to the time a check may take
+    if not EMAIL_CHECKS.acquire(timeout=EMAIL_API_TIMEOUT):
+        return True
+    try:
+        valid = EMAIL_VALIDATOR(email)
+    except Exception:
+        return True
+    finally:
+        EMAIL_CHECKS.release()
+    with EMAIL_CACHE_LOCK:
+        EMAIL_CACHE.set(key, valid, VALID_EMAIL_TTL if valid else INVALID_EMAIL_TTL)
+    return valid
 
 
 def get_value(username, column):
-    if is_value_in_column(USERNAME, username) and column in COLUMNS:
-        cursor = execute(f"select {column} from {TABLE_NAME} where {USERNAME} = '{username}';", return_cursor=True)
-        data = cursor.fetchone()
-        return data[0]
+    if column in COLUMNS:
+        data = execute(f"select {column} from {TABLE_NAME} where {USERNAME} = %s;", (username,), FETCH_ONE)
+        if data:
+            return data[0]
     return None
 
 
+def get_values(username, columns):
+    """
+    Returns: tuple of the user's values of the columns, or None if there is no such user
+    """
+    if not all(column in COLUMNS for column in columns):
+        return None
+    return execute(f"select {', '.join(columns)} from {TABLE_NAME} where {USERNAME} = %s;", (username,), FETCH_ONE)
+
+
 def update_value(username, column, new_value):
     if column in MANUALLY_MUTABLE_COLUMNS:
-        if is_value_in_column(USERNAME, username):
-            if check_value(column, new_value):
-                execute(f"update {TABLE_NAME} set {column} = '{new_value}'  where {USERNAME} = '{username}';")
-                return COMPLETE
+        # the checks that don't need the database, the update itself finds the user and the duplicates
+        if check_value(column, new_value, check_unique=False) != VALID:
+            return INVALID_VALUE_ERROR
+        try:
+            data = execute(f"update {TABLE_NAME} set {column} = %s where {USERNAME} = %s returning {USERNAME};",
+                           (new_value, username), FETCH_ONE)
+        except pg2_errors.UniqueViolation:
+            return ALREADY_EXISTS_ERROR
+        if data:
+            return COMPLETE
         return INVALID_VALUE_ERROR
     return INVALID_COLUMN_ERROR
 
 
+def increment_value(username, column, amount):
+    """
+    Returns: the new value, or None if there is no such user
+    """
+    if column in MANUALLY_MUTABLE_COLUMNS and get_type(column) in ['number', 'decimal']:
+        data = execute(f"update {TABLE_NAME} set {column} = {column} + %s where {USERNAME} = %s returning {column};",
+                       (amount, username), FETCH_ONE)
+        if data:
+            return data[0]
+    return None
+
+
+SETTLE_GAME_QUERY = (
+    f"with game as (insert into {GAMES_TABLE_NAME}(white, black, result, white_elo, black_elo) "
+    f"values (%s, %s, %s, %s, %s)) "
+    f"update {TABLE_NAME} set {ELO} = data.elo, {GAMES_PLAYED} = {TABLE_NAME}.{GAMES_PLAYED} + 1 "
+    f"from (values (%s, %s::decimal), (%s, %s::decimal)) as data(username, elo) "
+    f"where {TABLE_NAME}.{USERNAME} = data.username;"
+)
+
+
+def settle_games(games):
+    """
+    writes finished games in one transaction: every game is recorded and both of its players get
+    their new elo and one more game played, or nothing is written at all.
+    games: list of (white, black, result, white's new elo, black's new elo)
+    """
+    if not games:
+        return
+    with os_values.database_conn() as connection:
+        connection.autocommit = False
+        try:
+            # commits when the block ends, rolls back if it raises
+            with connection:
+                with connection.cursor() as cursor:
+                    for white, black, result, white_elo, black_elo in games:
+                        cursor.execute(SETTLE_GAME_QUERY,
+                                       (white, black, result, white_elo, black_elo, white, white_elo, black, black_elo))
+        finally:
+            if not connection.closed:
+                connection.autocommit = True
+
+
 def update_entry(username):
-    if is_value_in_column(USERNAME, username):
-        execute(f"update {TABLE_NAME} set {LAST_ENTRY} = current_timestamp  where {USERNAME} = '{username}';")
+    data = execute(f"update {TABLE_NAME} set {LAST_ENTRY} = current_timestamp where {USERNAME} = %s returning {USERNAME};",
+                   (username,), FETCH_ONE)
+    if data:
         return True
     return INVALID_VALUE_ERROR
 
 
 def main():
+    """
+    accounts_database.py                          prints the accounts
+    accounts_database.py export <file> [binary]  writes every account to the file
+    accounts_database.py import <file>           adds the accounts of a csv file
+    """
     os_values.set_database_conn()
-    columns = COLUMNS_L.copy()
-    columns.remove(PASSWORD)
-    print(printable_table(get_all_users(), columns))
+    if len(sys.argv) > 2 and sys.argv[1] == 'export':
+        file_format = sys.argv[3] if len(sys.argv) > 3 else 'csv'
+        with open(sys.argv[2], 'wb' if file_format == 'binary' else 'w', newline='') as file:
+            status = export_users(file, file_format=file_format)
+        print("accounts exported" if status == COMPLETE else "invalid export format")
+    elif len(sys.argv) > 2 and sys.argv[1] == 'import':
+        with open(sys.argv[2], newline='') as file:
+            imported, rejected = import_users(file)
+        print(f"{imported} accounts imported, {len(rejected)} rejected")
+        for line, column in rejected:
+            print(f"line {line}: invalid {column or 'row'}")
+    else:
+        columns = COLUMNS_L.copy()
+        columns.remove(PASSWORD)
+        print(printable_table(get_all_users(), columns))
+    os_values.close_database_conn()
 
 
 if __name__ == '__main__':
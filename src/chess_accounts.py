@@ -0,0 +1,112 @@
+from collections import deque
+
+import chess_leaderboard
+import handle_database as hd
+
+FLUSH_INTERVAL = 10  # seconds between writes of the changed ratings to the database
+
+
+class Account:
+    __slots__ = ('username', 'elo', 'games_played', 'logged_in')
+
+    def __init__(self, username, elo, games_played, logged_in=True):
+        self.username = username
+        self.elo = float(elo)
+        self.games_played = int(games_played)
+        self.logged_in = logged_in
+
+    def __repr__(self):
+        return f'Account({self.username}, {self.elo}, {self.games_played})'
+
+
+# the server is the only writer of the ratings, so the rows of the logged-in players are
+# kept here from login to logout, reads never touch the database, and finished games are
+# settled in memory right away and written behind in batches
+ACCOUNTS = {}
+PENDING_GAMES = deque()  # (white, black, result, white's new elo, black's new elo), oldest first
+SCORES = {'1-0': (1, 0), '0-1': (0, 1), '1/2-1/2': (0.5, 0.5)}
+
+
+def add_account(username, elo, games_played) -> Account:
+    account = ACCOUNTS.get(username)
+    if account:
+        # loaded before the player logged in, it may hold games that weren't written yet
+        account.logged_in = True
+        return account
+    account = Account(username, elo, games_played)
+    ACCOUNTS[username] = account
+    if username not in chess_leaderboard.LEADERBOARD:
+        # registered after the leaderboard was loaded
+        chess_leaderboard.LEADERBOARD.update(username, account.elo)
+    return account
+
+
+def get_account(username) -> Account:
+    account = ACCOUNTS.get(username)
+    if account is None:
+        data = hd.get_rating_data(username)
+        if data is None:
+            return None
+        # kept only until its games are written, the player isn't logged in here
+        account = ACCOUNTS[username] = Account(username, *data, logged_in=False)
+    return account
+
+
+def remove_account(username):
+    """
+    drops the account, called when the player logs out (or moves to another worker). nothing is
+    written here, an account with games still pending stays until the periodic flush writes them.
+    """
+    account = ACCOUNTS.get(username)
+    if account is None:
+        return
+    account.logged_in = False
+    if not PENDING_GAMES:
+        del ACCOUNTS[username]
+
+
+def get_elo(username):
+    return get_account(username).elo
+
+
+def get_games_played(username):
+    return get_account(username).games_played
+
+
+def get_new_elo(elo, opponent_elo, games_played, score):
+    """
+    RatA + K * (score - (1 / (1 + 10(RatB - RatA)/400)))
+    K = 400/games_played + 16, the settled game included
+    """
+    k = 400 / (games_played + 1) + 16
+    return elo + k * (score - (1 / (1 + 10 ** ((opponent_elo - elo) / 400))))
+
+
+def settle_game(white, black, result):
+    white_account, black_account = get_account(white), get_account(black)
+    white_score, black_score = SCORES[result]
+    white_elo = get_new_elo(white_account.elo, black_account.elo, white_account.games_played, white_score)
+    black_elo = get_new_elo(black_account.elo, white_account.elo, black_account.games_played, black_score)
+    white_account.elo, black_account.elo = white_elo, black_elo
+    chess_leaderboard.LEADERBOARD.update(white, white_elo)
+    chess_leaderboard.LEADERBOARD.update(black, black_elo)
+    white_account.games_played += 1
+    black_account.games_played += 1
+    PENDING_GAMES.append((white, black, result, white_elo, black_elo))
+
+
+def flush():
+    """
+    writes the pending games in one transaction. if it fails they are queued again in
+    front of the games settled meanwhile, so they are written once and in order.
+    """
+    games = list(PENDING_GAMES)
+    PENDING_GAMES.clear()
+    try:
+        hd.settle_games(games)
+    except Exception:
+        PENDING_GAMES.extendleft(reversed(games))
+        raise
+    if not PENDING_GAMES:
+        for username in [username for username, account in ACCOUNTS.items() if not account.logged_in]:
+            del ACCOUNTS[username]
@@ -13,6 +13,7 @@ DATA_DELIMITER = "#"  # Delimiter in the data part of the message
 
 PROTOCOL_CLIENT = {
     "login_msg": "LOGIN",
+    "resume_msg": "RESUME",
     "first_login_msg": "NEW_LOGIN",
     "logout_msg": "LOGOUT",
     "my_move_msg": "MY_MOVE",
@@ -21,6 +22,9 @@ PROTOCOL_CLIENT = {
     "multiplayer": "PVP",
     "single-player": "PVE",
     "get_my_rating": "MY_RATING",
+    "get_my_rank": "MY_RANK",
+    "get_top_players": "TOP_PLAYERS",
+    "get_players_around_me": "AROUND_ME",
     "get_logged_users": "LOGGED"
 }
 
@@ -33,6 +37,7 @@ PROTOCOL_SERVER = {
     "logged_users": "LOGGED_USERS",
     "looking_for_opponent_msg": "FINDING_OPPONENT",
     "no_opponent_found_msg": "NO_OPPONENT",
+    "server_busy_msg": "SERVER_BUSY",
     "game_started_msg": "GAME_STARTED",
     "opponent_quit_msg": "OPPONENT_QUIT",
     "your_move_msg": "YOUR_MOVE",
@@ -41,6 +46,9 @@ PROTOCOL_SERVER = {
     "opponent_move_msg": "OPPONENT_MOVE",
     "game_over_msg": "GAME_OVER",
     "get_rating_msg": "YOUR_RATING",
+    "rank_msg": "YOUR_RANK",
+    "top_players_msg": "TOP_PLAYERS_LIST",
+    "players_around_msg": "PLAYERS_AROUND",
     "logged_users_msg": "LOGGED_USERS",
     "no_update_msg": "NO_UPDATE",
 
@@ -87,13 +95,15 @@ ERROR_RETURN = None  # What is returned in case of an error
 
 def build_message(cmd, data):
     """
-    Gets command name (str) and data field (str) and creates a valid protocol message
+    Gets command name (str) and data field (str) and creates a valid protocol message,
+    the length field counts the bytes of the encoded data (the frames are cut in bytes)
     Returns: str, or None if error occurred
     """
-    if len(cmd) > CMD_FIELD_LENGTH or len(data) > MAX_DATA_LENGTH:
+    data_size = len(data.encode())
+    if len(cmd) > CMD_FIELD_LENGTH or data_size > MAX_DATA_LENGTH:
         return ERROR_RETURN
     cmd += " " * (CMD_FIELD_LENGTH - len(cmd))
-    data_len = str(len(data))
+    data_len = str(data_size)
     data_len = "0" * (4 - len(data_len)) + data_len
     full_msg = cmd + DELIMITER + data_len + DELIMITER + data
     return full_msg
@@ -110,13 +120,37 @@ def parse_message(data):
     for char in data[1]:
         if (ord(char) > 57 or ord(char) < 48) and char!= " ":
             return ERROR_RETURN, ERROR_RETURN
-    if len(data[0]) > CMD_FIELD_LENGTH or len(data[1]) > LENGTH_FIELD_LENGTH or len(data[2]) != int(data[1]):
+    if len(data[0]) > CMD_FIELD_LENGTH or len(data[1]) > LENGTH_FIELD_LENGTH or len(data[2].encode()) != int(data[1]):
         return ERROR_RETURN, ERROR_RETURN
     msg = data[2]
     cmd = data[0].replace(" ", "")
     return cmd, msg
 
 
+def get_frame_length(buffer, start=0):
+    """
+    Gets a bytes-like buffer holding a stream of protocol messages and the offset of the
+    first message in it, and finds where that message ends (without copying the buffer).
+    Returns: length (int) of the first message, 0 if it didn't fully arrive yet
+    or ERROR_RETURN if the stream doesn't start with a valid header
+    """
+    delimiter = DELIMITER.encode()
+    buffered = len(buffer) - start
+    cmd_end = buffer.find(delimiter, start, start + CMD_FIELD_LENGTH + 1)
+    if cmd_end == -1:
+        return 0 if buffered <= CMD_FIELD_LENGTH else ERROR_RETURN
+    length_end = buffer.find(delimiter, cmd_end + 1, cmd_end + LENGTH_FIELD_LENGTH + 2)
+    if length_end == -1:
+        return 0 if buffered <= cmd_end - start + LENGTH_FIELD_LENGTH + 1 else ERROR_RETURN
+    data_length = bytes(buffer[cmd_end + 1:length_end]).strip()
+    if not data_length.isdigit():
+        return ERROR_RETURN
+    msg_length = length_end + 1 - start + int(data_length)
+    if buffered < msg_length:
+        return 0
+    return msg_length
+
+
 def split_data(msg, expected_fields):
     """
     Helper method. gets a string and number of expected fields in it. Splits the string
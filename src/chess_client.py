@@ -8,6 +8,10 @@ from threading import Thread
 
 SERVER_IP = "127.0.0.1"
 SERVER_PORT = 5678
+SESSION_TOKEN = ""
+RECV_SIZE = 1024
+RESUME_GAME_WAIT = 0.5  # seconds to wait for the game of a resumed session after LOGIN_OK
+RECV_BUFFERS = {}  # socket -> bytes received but not parsed yet
 
 # HELPER SOCKET METHODS
 pieces = {
@@ -46,10 +50,30 @@ def recv_message_and_parse(conn):
     """
     Receives a new message from given socket,
     then parses the message using chatlib.
+    The bytes after the message stay buffered for the next call.
     Parameters: CONN (socket object)
     Returns: cmd (str) and data (str) of the received message.
-    If error occurred, will return None, None"""
-    return chatlib.parse_message(conn.recv(1024).decode())
+    If error occurred, will return None, None
+    Raises ConnectionError if the server closed the connection"""
+    buffer = RECV_BUFFERS.setdefault(conn, bytearray())
+    while True:
+        length = chatlib.get_frame_length(buffer)
+        if length is None:
+            buffer.clear()
+            return None, None
+        if length:
+            msg = bytes(buffer[:length])
+            del buffer[:length]
+            return chatlib.parse_message(msg.decode(errors='replace'))
+        data = conn.recv(RECV_SIZE)
+        if not data:
+            raise ConnectionError("the server closed the connection")
+        buffer += data
+
+
+def close_connection(conn):
+    RECV_BUFFERS.pop(conn, None)
+    conn.close()
 
 
 def fen_to_full_board(fen_board) -> list:
@@ -93,6 +117,27 @@ def get_rating(conn):
     print(message_code, data)
 
 
+def print_ranking(data):
+    if not data:
+        return
+    for entry in data.split(chatlib.DATA_DELIMITER):
+        rank, username, elo = entry.split(',')
+        print(f"{rank:>6}  {username:<32} {elo}")
+
+
+def get_rank(conn):
+    msg_code, data = build_send_recv_parse(conn, chatlib.PROTOCOL_CLIENT["get_my_rank"], "")
+    rank, total = data.split(chatlib.DATA_DELIMITER)
+    print(f"your rank is {rank} of {total}")
+    msg_code, data = build_send_recv_parse(conn, chatlib.PROTOCOL_CLIENT["get_players_around_me"], "")
+    print_ranking(data)
+
+
+def get_top_players(conn):
+    msg_code, data = build_send_recv_parse(conn, chatlib.PROTOCOL_CLIENT["get_top_players"], "")
+    print_ranking(data)
+
+
 def get_logged_users(conn):
     msg_code, data = build_send_recv_parse(conn, chatlib.PROTOCOL_CLIENT["get_logged_users"], "")
     print(data)
@@ -137,13 +182,23 @@ def play_game(conn, pvp=True):
     if msg_code == chatlib.PROTOCOL_SERVER['no_opponent_found_msg']:
         print('no opponent found')
         return
+    if msg_code == chatlib.PROTOCOL_SERVER['server_busy_msg']:
+        print('the server is busy, try again later')
+        return
     color, fen = data.split(chatlib.DATA_DELIMITER)
-    if color == 'white':
-        print_board(fen, color)
+    play_moves(conn, color, fen)
+
+
+def play_moves(conn, color, fen):
+    """
+    plays a started (or resumed) game until it ends.
+    """
+    print_board(fen, color)
+    turn = 'white' if fen.split()[1] == 'w' else 'black'
+    if turn == color:
         if get_move_and_send(conn) == 'quit':
             return
     else:
-        print_board(fen, color)
         print("waiting for opponent move")
     while True:
         msg_code, data = recv_message_and_parse(conn)
@@ -178,6 +233,44 @@ def connect():
     return the_socket
 
 
+def reconnect():
+    """
+    opens a new connection after the old one was lost and resumes the session on it,
+    logging in again if the session expired.
+    Returns: the new socket and the game to go back to (see recv_resumed_game)
+    """
+    global SESSION_TOKEN
+    the_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    the_socket.connect((SERVER_IP, SERVER_PORT))
+    cmd, data = build_send_recv_parse(the_socket, chatlib.PROTOCOL_CLIENT["resume_msg"], SESSION_TOKEN)
+    if cmd == chatlib.PROTOCOL_SERVER["login_ok_msg"]:
+        SESSION_TOKEN = data
+        print("connection restored")
+        return the_socket, recv_resumed_game(the_socket)
+    print("session expired, please log in again")
+    return the_socket, login(the_socket)
+
+
+def recv_resumed_game(conn):
+    """
+    a resumed session that is in a game is followed by GAME_STARTED with the colour and the
+    current board, the server sends it right after LOGIN_OK.
+    Returns: (color, fen) of the game, or None if the session isn't in a game
+    """
+    if not chatlib.get_frame_length(RECV_BUFFERS.get(conn, b'')):
+        conn.settimeout(RESUME_GAME_WAIT)
+    try:
+        cmd, data = recv_message_and_parse(conn)
+    except socket.timeout:
+        return None
+    finally:
+        conn.settimeout(None)
+    if cmd != chatlib.PROTOCOL_SERVER["game_started_msg"]:
+        return None
+    color, fen = data.split(chatlib.DATA_DELIMITER)
+    return color, fen
+
+
 def error_and_exit(error_msg):
     print(error_msg)
     exit()
@@ -192,27 +285,31 @@ def first_login(conn):
         cmd, data = recv_message_and_parse(conn)
         if cmd == chatlib.PROTOCOL_SERVER["account_created_msg"]:
             print("account created")
-            login(conn)
-            break
+            return login(conn)
         elif cmd == chatlib.PROTOCOL_SERVER["invalid_data_msg"]:
             print(data)
 
 
 def login(conn):
+    """
+    Returns: the game to go back to if the login resumed a session in a game (see recv_resumed_game)
+    """
+    global SESSION_TOKEN
     while True:
         username = input("enter username: ")
         password = input("enter password: ")
         build_and_send_message(conn, chatlib.PROTOCOL_CLIENT["login_msg"], chatlib.join_data([username, password]))
         cmd, data = recv_message_and_parse(conn)
         if cmd == chatlib.PROTOCOL_SERVER["login_ok_msg"]:
+            SESSION_TOKEN = data
             print("logged in")
-            break
+            return recv_resumed_game(conn)
         print(data)
 
 
 def logout(conn):
     build_and_send_message(conn, chatlib.PROTOCOL_CLIENT["logout_msg"], "")
-    conn.close()
+    close_connection(conn)
     print("goodbye")
 
 
@@ -244,26 +341,44 @@ def main():
     while has_acc not in ['n', 'y', 'N', 'Y']:
         has_acc = input("do you have an account? (y/n): ")
     if has_acc.lower() == 'y':
-        login(conn)
+        game = login(conn)
     else:
-        first_login(conn)
+        game = first_login(conn)
     while True:
+        if game:
+            try:
+                play_moves(conn, *game)
+                game = None
+            except OSError:
+                close_connection(conn)
+                conn, game = reconnect()
+            continue
         print("p        Play PvP game\n"
               "e        Play PvE game\n"
               "s        Get my rating\n"
+              "r        Get my rank\n"
+              "t        Show top players\n"
               "l        Get logged users list\n"
               "q        Quit\n")
         choice = input("enter choice:")
-        if choice == "s":
-            get_rating(conn)
-        elif choice == "p":
-            play_game(conn)
-        elif choice == "e":
-            play_game(conn, False)
-        elif choice == "l":
-            get_logged_users(conn)
-        elif choice == "q":
-            break
+        try:
+            if choice == "s":
+                get_rating(conn)
+            elif choice == "r":
+                get_rank(conn)
+            elif choice == "t":
+                get_top_players(conn)
+            elif choice == "p":
+                play_game(conn)
+            elif choice == "e":
+                play_game(conn, False)
+            elif choice == "l":
+                get_logged_users(conn)
+            elif choice == "q":
+                break
+        except OSError:
+            close_connection(conn)
+            conn, game = reconnect()
     logout(conn)
 if __name__ == '__main__':
     main()
@@ -0,0 +1,306 @@
+import json
+import os
+import selectors
+import signal
+import socket
+import time
+
+import chess_matchmaking
+
+MAX_PACKET_SIZE = 256 * 1024
+MAX_HANDOFF_SIZE = 64 * 1024  # bytes of state passed along with a client socket, well under the socket buffers
+REAP_INTERVAL = 1
+MATCH_INTERVAL = 2  # seconds between attempts to pair players that already wait
+LOCAL_WORKER = 0
+
+
+def send_packet(channel, msg, fd=None):
+    data = json.dumps(msg).encode()
+    if fd is None:
+        channel.send(data)
+    else:
+        socket.send_fds(channel, [data], [fd])
+
+
+def recv_packet(channel):
+    """
+    Receives one packet (and the file descriptor passed along with it, if any).
+    Returns: msg (dict) and fd (int or None), or None, None if the other side closed the channel
+    """
+    data, fds, flags, address = socket.recv_fds(channel, MAX_PACKET_SIZE, 1)
+    if not data:
+        return None, None
+    return json.loads(data), fds[0] if fds else None
+
+
+class Coordinator:
+    """
+    State shared by every server worker: which worker each logged-in user is connected to,
+    and the users waiting for a PvP opponent (with the worker they wait on).
+    """
+
+    def __init__(self):
+        self.logged_users = {}
+        self.waiting_room = chess_matchmaking.MatchmakingQueue()
+
+    def claim(self, username, worker) -> bool:
+        if username in self.logged_users:
+            return False
+        self.logged_users[username] = worker
+        return True
+
+    def release(self, username):
+        self.logged_users.pop(username, None)
+        self.waiting_room.remove(username)
+
+    def enqueue(self, username, worker, rating):
+        """
+        Returns: (opponent, opponent's worker) if a suitable opponent was waiting, otherwise
+        the user is added to the waiting room and None is returned
+        """
+        if username in self.waiting_room:
+            return None
+        opponent = self.waiting_room.pop_opponent(rating)
+        if opponent:
+            return opponent.username, opponent.data
+        self.waiting_room.add(username, rating, worker)
+        return None
+
+    def dequeue(self, username) -> bool:
+        """
+        Returns: False if the user was no longer waiting (he was already paired)
+        """
+        return self.waiting_room.remove(username) is not None
+
+    def match_waiting(self) -> list:
+        """
+        Returns: list of (username, his worker, opponent, opponent's worker) for the waiting
+        players that were paired since their windows widened
+        """
+        return [(player.username, player.data, opponent.username, opponent.data)
+                for player, opponent in self.waiting_room.match_waiting()]
+
+    def locate(self, username):
+        """
+        Returns: the worker the user is logged in on, None if the user isn't logged in
+        """
+        return self.logged_users.get(username)
+
+    def move_user(self, username, worker):
+        if username in self.logged_users:
+            self.logged_users[username] = worker
+
+    def release_worker(self, worker):
+        for username in [user for user, user_worker in self.logged_users.items() if user_worker == worker]:
+            self.release(username)
+
+
+class LocalCoordinator:
+    """
+    Coordinator used when the server runs as a single process.
+    """
+
+    def __init__(self):
+        self.coordinator = Coordinator()
+
+    def claim(self, username) -> bool:
+        return self.coordinator.claim(username, LOCAL_WORKER)
+
+    def release(self, username):
+        self.coordinator.release(username)
+
+    def enqueue(self, username, rating):
+        return self.coordinator.enqueue(username, LOCAL_WORKER, rating)
+
+    def dequeue(self, username) -> bool:
+        return self.coordinator.dequeue(username)
+
+    def match_waiting(self) -> list:
+        return [(username, opponent, opponent_worker)
+                for username, worker, opponent, opponent_worker in self.coordinator.match_waiting()]
+
+    def locate(self, username):
+        return self.coordinator.locate(username)
+
+    def handoff(self, state, worker, fd) -> bool:
+        return False
+
+
+class CoordinatorClient:
+    """
+    Worker side of the channels to the supervisor. Requests go over the rpc channel and
+    wait for their reply; pairings made by the supervisor and clients handed off by other
+    workers arrive on the push channel, which the worker watches in its selector.
+    """
+
+    def __init__(self, worker, rpc_channel, push_channel):
+        self.worker = worker
+        self.rpc_channel = rpc_channel
+        self.push_channel = push_channel
+
+    def fileno(self):
+        return self.push_channel.fileno()
+
+    def _call(self, msg, fd=None):
+        send_packet(self.rpc_channel, msg, fd)
+        reply, _ = recv_packet(self.rpc_channel)
+        if reply is None:
+            raise ConnectionError('supervisor is down')
+        return reply['reply']
+
+    def claim(self, username) -> bool:
+        return self._call({'op': 'claim', 'user': username})
+
+    def release(self, username):
+        self._call({'op': 'release', 'user': username})
+
+    def enqueue(self, username, rating):
+        pair = self._call({'op': 'enqueue', 'user': username, 'rating': float(rating)})
+        return tuple(pair) if pair else None
+
+    def dequeue(self, username) -> bool:
+        return self._call({'op': 'dequeue', 'user': username})
+
+    def locate(self, username):
+        return self._call({'op': 'locate', 'user': username})
+
+    def handoff(self, state, worker, fd) -> bool:
+        """
+        Passes a client socket (and its session state) to another worker.
+        Returns: False if the other worker didn't get it, or the state is too big to pass
+        """
+        if len(json.dumps(state)) > MAX_HANDOFF_SIZE:
+            return False
+        return self._call({'op': 'handoff', 'worker': worker, 'state': state}, fd)
+
+    def receive_push(self):
+        """
+        Returns: msg (dict) and fd (int or None). msg['op'] is 'adopt' for a client handed off
+        to this worker (fd is its socket) or 'paired' for a waiting user that got an opponent
+        """
+        msg, fd = recv_packet(self.push_channel)
+        if msg is None:
+            raise ConnectionError('supervisor is down')
+        return msg, fd
+
+
+class Supervisor:
+    """
+    Forks the server workers and serves their coordination requests. Every worker runs its own
+    game loop on a SO_REUSEPORT listener, a worker that dies is forked again.
+    """
+
+    def __init__(self, workers_count, worker_main):
+        self.workers_count = workers_count
+        self.worker_main = worker_main
+        self.coordinator = Coordinator()
+        self.selector = selectors.DefaultSelector()
+        self.workers = {}  # worker id -> (pid, rpc channel, push channel)
+
+    def spawn(self, worker):
+        rpc_parent, rpc_child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        push_parent, push_child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        pid = os.fork()
+        if pid == 0:
+            self.selector.close()
+            for _, rpc_channel, push_channel in self.workers.values():
+                rpc_channel.close()
+                push_channel.close()
+            rpc_parent.close()
+            push_parent.close()
+            status = 0
+            try:
+                self.worker_main(CoordinatorClient(worker, rpc_child, push_child))
+            except BaseException:
+                status = 1
+            finally:
+                os._exit(status)
+        rpc_child.close()
+        push_child.close()
+        self.workers[worker] = (pid, rpc_parent, push_parent)
+        self.selector.register(rpc_parent, selectors.EVENT_READ, worker)
+        print(f"worker {worker} started (pid {pid})")
+
+    def serve(self, worker):
+        rpc_channel = self.workers[worker][1]
+        msg, fd = recv_packet(rpc_channel)
+        if msg is None:
+            self.selector.unregister(rpc_channel)
+            return
+        op = msg['op']
+        reply = None
+        if op == 'claim':
+            reply = self.coordinator.claim(msg['user'], worker)
+        elif op == 'release':
+            self.coordinator.release(msg['user'])
+        elif op == 'enqueue':
+            reply = self.coordinator.enqueue(msg['user'], worker, msg['rating'])
+        elif op == 'dequeue':
+            reply = self.coordinator.dequeue(msg['user'])
+        elif op == 'locate':
+            reply = self.coordinator.locate(msg['user'])
+        elif op == 'handoff':
+            reply = self.handoff(msg['state'], msg['worker'], fd)
+        send_packet(rpc_channel, {'reply': reply})
+
+    def handoff(self, state, worker, fd) -> bool:
+        try:
+            if worker not in self.workers:
+                return False
+            send_packet(self.workers[worker][2], {'op': 'adopt', 'state': state}, fd)
+            self.coordinator.move_user(state['user'], worker)
+            return True
+        except OSError:
+            return False
+        finally:
+            os.close(fd)
+
+    def match_waiting(self):
+        for username, worker, opponent, opponent_worker in self.coordinator.match_waiting():
+            msg = {'op': 'paired', 'user': username, 'opponent': opponent, 'worker': opponent_worker}
+            try:
+                send_packet(self.workers[worker][2], msg)
+            except (KeyError, OSError):
+                pass
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            for worker, (worker_pid, rpc_channel, push_channel) in list(self.workers.items()):
+                if worker_pid == pid:
+                    print(f"worker {worker} exited, restarting it")
+                    if rpc_channel in self.selector.get_map():
+                        self.selector.unregister(rpc_channel)
+                    rpc_channel.close()
+                    push_channel.close()
+                    del self.workers[worker]
+                    self.coordinator.release_worker(worker)
+                    self.spawn(worker)
+
+    def stop(self):
+        for pid, rpc_channel, push_channel in self.workers.values():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        self.selector.close()
+
+    def run(self):
+        for worker in range(self.workers_count):
+            self.spawn(worker)
+        last_match = time.monotonic()
+        try:
+            while True:
+                for key, mask in self.selector.select(REAP_INTERVAL):
+                    self.serve(key.data)
+                self.reap_workers()
+                if time.monotonic() - last_match > MATCH_INTERVAL:
+                    self.match_waiting()
+                    last_match = time.monotonic()
+        finally:
+            self.stop()
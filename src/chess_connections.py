@@ -0,0 +1,146 @@
+import socket
+import time
+from collections import deque
+from itertools import islice
+
+import chess_chatlib as chatlib
+
+MAX_IOV = 64  # max messages gathered into a single sendmsg call
+
+
+class ClientConnection:
+    """
+    State kept for every client socket registered in the server's selector.
+    The object is stored as the selector key data, so a readiness event
+    leads straight to the connection without searching any list.
+    """
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.ip = address[0]
+        self.connected_at = time.monotonic()
+        self.last_activity = self.connected_at
+        self.idle_timer = None
+        self.recv_buffer = bytearray()
+        self.read_pos = 0
+        self.deferred_messages = []
+        self.send_queue = deque()
+        self.pending_bytes = 0
+        self.events = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def receive(self, size):
+        """
+        Reads whatever is available on the socket into the connection's buffer.
+        Returns: False if the client closed the connection, True otherwise
+        """
+        data = self.sock.recv(size)
+        if not data:
+            return False
+        self.recv_buffer += data
+        self.last_activity = time.monotonic()
+        return True
+
+    def pop_messages(self, max_msg_size):
+        """
+        Takes every complete message out of the receive buffer, a partial message
+        stays buffered until the rest of it arrives.
+        Returns: list of raw messages (str), and False if the stream is corrupted
+        (bad header or a message longer than max_msg_size), True otherwise
+        """
+        messages = []
+        is_valid = True
+        while True:
+            length = chatlib.get_frame_length(self.recv_buffer, self.read_pos)
+            if length is chatlib.ERROR_RETURN or length > max_msg_size:
+                is_valid = False
+                break
+            if not length:
+                is_valid = len(self.recv_buffer) - self.read_pos <= max_msg_size
+                break
+            end = self.read_pos + length
+            messages.append(self.recv_buffer[self.read_pos:end].decode(errors='replace'))
+            self.read_pos = end
+        self._compact()
+        return messages, is_valid
+
+    def _compact(self):
+        # consumed bytes are only dropped once they make up most of the buffer,
+        # so a burst of small messages doesn't shift the remaining bytes every time
+        if self.read_pos == len(self.recv_buffer):
+            self.recv_buffer.clear()
+            self.read_pos = 0
+        elif self.read_pos > len(self.recv_buffer) // 2:
+            del self.recv_buffer[:self.read_pos]
+            self.read_pos = 0
+
+    def queue_message(self, data):
+        self.send_queue.append(data)
+        self.pending_bytes += len(data)
+
+    def flush(self):
+        """
+        Sends as much of the queued output as the socket accepts. Queued messages are
+        gathered into one sendmsg call and a partially sent message keeps its unsent tail.
+        Returns: True if the whole queue was sent
+        """
+        while self.send_queue:
+            buffers = list(islice(self.send_queue, MAX_IOV))
+            try:
+                if hasattr(self.sock, 'sendmsg'):
+                    sent = self.sock.sendmsg(buffers)
+                else:
+                    sent = self.sock.send(b''.join(buffers))
+            except BlockingIOError:
+                return False
+            self.pending_bytes -= sent
+            is_socket_full = sent < sum(len(buffer) for buffer in buffers)
+            while sent:
+                head = self.send_queue[0]
+                if sent < len(head):
+                    self.send_queue[0] = memoryview(head)[sent:]
+                    break
+                sent -= len(head)
+                self.send_queue.popleft()
+            if is_socket_full:
+                return False
+        return True
+
+    def __repr__(self):
+        return f'ClientConnection({self.ip}:{self.address[1]})'
+
+
+class Waker:
+    """
+    Self-pipe used by worker threads to interrupt the selector's wait,
+    so the event loop reacts to their results without polling.
+    """
+
+    def __init__(self):
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+        self.writer.setblocking(False)
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def wake(self):
+        try:
+            self.writer.send(b'\0')
+        except OSError:
+            # the pipe is already full, the loop is going to wake up anyway
+            pass
+
+    def drain(self):
+        try:
+            while self.reader.recv(4096):
+                pass
+        except OSError:
+            pass
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
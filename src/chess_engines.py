@@ -0,0 +1,247 @@
+import heapq
+import itertools
+import json
+import os
+import queue
+import random
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+import chess.engine
+import chess.polyglot
+
+POOL_SIZE = os.cpu_count() or 2
+ENGINE_HASH_MB = 16
+ENGINE_TIMEOUT = 10  # seconds an engine has to answer a ping
+CACHE_SIZE = 200000
+CACHE_MAX_PLY = 12  # only opening positions are cached
+CACHE_SAMPLES = 4  # searches sampled per position before a weakened level is served from the cache
+FULL_STRENGTH_LEVEL = 20
+MOVE_PRIORITY = 0
+PONDER_PRIORITY = 1
+
+
+class EnginePool:
+    """
+    Fixed number of long-lived UCI engine processes, checked out for one search at a time.
+    Engines are started lazily up to `size`, pinged when checked out and replaced if they crash,
+    so a search costs only its search time and the process count stays bounded.
+    """
+
+    def __init__(self, path_getter, size=POOL_SIZE):
+        self.path_getter = path_getter
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.started = 0
+        self.lock = threading.Lock()
+
+    def _start_engine(self) -> chess.engine.SimpleEngine:
+        engine = chess.engine.SimpleEngine.popen_uci(self.path_getter(), timeout=ENGINE_TIMEOUT)
+        engine.configure({'Hash': ENGINE_HASH_MB, 'Threads': 1})
+        return engine
+
+    def acquire(self, timeout=None, block=True) -> chess.engine.SimpleEngine:
+        """
+        Raises queue.Empty if block is False (or the timeout passed) and every engine is busy.
+        """
+        with self.lock:
+            should_start = self.idle.empty() and self.started < self.size
+            if should_start:
+                self.started += 1
+        if should_start:
+            try:
+                return self._start_engine()
+            except BaseException:
+                with self.lock:
+                    self.started -= 1
+                raise
+        engine = self.idle.get(block, timeout)
+        try:
+            engine.ping()
+        except (chess.engine.EngineError, chess.engine.EngineTerminatedError, TimeoutError):
+            self.discard(engine)
+            return self.acquire(timeout, block)
+        return engine
+
+    def release(self, engine):
+        self.idle.put(engine)
+
+    def discard(self, engine):
+        with self.lock:
+            self.started -= 1
+        try:
+            engine.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def engine(self, timeout=None, block=True):
+        engine = self.acquire(timeout, block)
+        try:
+            yield engine
+        except BaseException:
+            # the engine may be left in the middle of a search, a new one replaces it
+            self.discard(engine)
+            raise
+        else:
+            self.release(engine)
+
+    def close(self):
+        while True:
+            try:
+                engine = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            self.discard(engine)
+
+
+class EngineScheduler:
+    """
+    Queue of engine jobs run by a fixed number of threads (one per engine of the pool), so
+    searches never use more cores than the pool has. Jobs run by priority, and oldest first
+    within a priority. Threads are started with the first job, after the workers are forked.
+    """
+
+    def __init__(self, workers=POOL_SIZE):
+        self.workers = workers
+        self.heap = []  # (priority, queued time, sequence, function, args)
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.threads = []
+        self.queued = Counter()  # priority -> jobs waiting
+        self.running = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.closed = False
+
+    def submit(self, priority, function, *args):
+        with self.condition:
+            if self.closed:
+                return
+            heapq.heappush(self.heap, (priority, time.monotonic(), next(self.counter), function, args))
+            self.queued[priority] += 1
+            if len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._run, daemon=True)
+                self.threads.append(thread)
+                thread.start()
+            self.condition.notify()
+
+    def waiting(self, priority=None) -> int:
+        if priority is None:
+            return len(self.heap)
+        return self.queued[priority]
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.heap and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                priority, queued_at, _, function, args = heapq.heappop(self.heap)
+                self.queued[priority] -= 1
+                self.running += 1
+                wait = time.monotonic() - queued_at
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            try:
+                function(*args)
+            except Exception as e:
+                print(f"engine job failed: {e}")
+            finally:
+                with self.condition:
+                    self.running -= 1
+                    self.completed += 1
+
+    def stats(self) -> dict:
+        with self.condition:
+            started = self.completed + self.running
+            return {
+                'queued': len(self.heap),
+                'queued_moves': self.queued[MOVE_PRIORITY],
+                'running': self.running,
+                'completed': self.completed,
+                'average_wait': self.total_wait / started if started else 0.0,
+                'max_wait': self.max_wait
+            }
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.heap.clear()
+            self.queued.clear()
+            self.condition.notify_all()
+
+
+class MoveCache:
+    """
+    LRU cache of engine moves keyed by the position's Zobrist hash and the skill level.
+    A full strength engine plays the same move every time, so one search is enough. Weaker
+    levels play randomly, so a position collects several searched moves first and then one of
+    them is picked at random, keeping the engine's move choice as varied as before.
+    """
+
+    def __init__(self, max_size=CACHE_SIZE, max_ply=CACHE_MAX_PLY):
+        self.max_size = max_size
+        self.max_ply = max_ply
+        self.entries = OrderedDict()  # (zobrist hash, level) -> list of uci moves
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def samples_needed(level) -> int:
+        return 1 if level >= FULL_STRENGTH_LEVEL else CACHE_SAMPLES
+
+    def is_cacheable(self, board) -> bool:
+        return board.ply() <= self.max_ply
+
+    def get(self, board, level):
+        """
+        Returns: a cached move (chess.Move) for the position, or None if it has to be searched
+        """
+        if not self.is_cacheable(board):
+            return None
+        key = (chess.polyglot.zobrist_hash(board), level)
+        with self.lock:
+            moves = self.entries.get(key)
+            if moves is None or len(moves) < self.samples_needed(level):
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            move = chess.Move.from_uci(random.choice(moves))
+        # guards against hash collisions
+        return move if move in board.legal_moves else None
+
+    def add(self, board, level, move):
+        if not self.is_cacheable(board):
+            return
+        key = (chess.polyglot.zobrist_hash(board), level)
+        with self.lock:
+            moves = self.entries.setdefault(key, [])
+            if len(moves) < self.samples_needed(level):
+                moves.append(move.uci())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return
+        with open(path) as file:
+            entries = json.load(file)
+        with self.lock:
+            for zobrist_hash, level, moves in entries[-self.max_size:]:
+                self.entries[(zobrist_hash, level)] = moves
+
+    def save(self, path):
+        with self.lock:
+            entries = [[zobrist_hash, level, moves] for (zobrist_hash, level), moves in self.entries.items()]
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(entries, file)
+        os.replace(temp_path, path)
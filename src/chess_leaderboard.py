@@ -0,0 +1,68 @@
+from sortedcontainers import SortedList
+
+MAX_LISTED_PLAYERS = 100
+
+
+class Leaderboard:
+    """
+    Every player's elo, ordered. The entries are (-elo, username) keys in a SortedList,
+    so updating a rating, finding a player's rank and slicing around a rank are all O(log n)
+    and no request ever scans the accounts table.
+    """
+
+    def __init__(self):
+        self.entries = SortedList()
+        self.ratings = {}  # username -> elo
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, username):
+        return username in self.ratings
+
+    def load(self, ratings):
+        """
+        ratings: iterable of (username, elo)
+        """
+        self.ratings = {username: float(elo) for username, elo in ratings}
+        self.entries = SortedList((-elo, username) for username, elo in self.ratings.items())
+
+    def update(self, username, elo):
+        self.remove(username)
+        self.ratings[username] = float(elo)
+        self.entries.add((-float(elo), username))
+
+    def remove(self, username):
+        elo = self.ratings.pop(username, None)
+        if elo is not None:
+            self.entries.remove((-elo, username))
+
+    def rank(self, username):
+        """
+        Returns: the player's place (1 is the highest elo), or None if the player isn't ranked
+        """
+        elo = self.ratings.get(username)
+        if elo is None:
+            return None
+        return self.entries.index((-elo, username)) + 1
+
+    def _slice(self, start, stop) -> list:
+        return [(rank, username, -key) for rank, (key, username) in enumerate(self.entries[start:stop], start + 1)]
+
+    def top(self, count) -> list:
+        """
+        Returns: list of (rank, username, elo) of the count highest rated players
+        """
+        return self._slice(0, count)
+
+    def around(self, username, count) -> list:
+        """
+        Returns: list of (rank, username, elo) of the player and the count players above and below
+        """
+        rank = self.rank(username)
+        if rank is None:
+            return []
+        return self._slice(max(0, rank - 1 - count), rank + count)
+
+
+LEADERBOARD = Leaderboard()
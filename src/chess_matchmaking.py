@@ -0,0 +1,131 @@
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+BUCKET_SIZE = 50  # elo points covered by a bucket
+BASE_WINDOW = 150  # max elo difference accepted right away
+WINDOW_GROWTH = 25  # elo points the window widens by for every second of waiting
+MAX_WINDOW = 3500
+
+
+def get_window(waited) -> float:
+    return min(MAX_WINDOW, BASE_WINDOW + WINDOW_GROWTH * waited)
+
+
+def get_bucket_gap(rating, key) -> float:
+    """
+    Returns: the smallest elo difference between the rating and a player of the bucket
+    """
+    return max(0.0, key * BUCKET_SIZE - rating, rating - (key + 1) * BUCKET_SIZE)
+
+
+class WaitingPlayer:
+    __slots__ = ('username', 'rating', 'since', 'data')
+
+    def __init__(self, username, rating, since, data):
+        self.username = username
+        self.rating = rating
+        self.since = since
+        self.data = data
+
+
+class MatchmakingQueue:
+    """
+    Players waiting for a PvP opponent, indexed by elo bucket. The non-empty buckets are kept
+    in a sorted list, so finding an opponent is a bisect plus a walk over the few buckets
+    within reach, and every bucket is ordered oldest first.
+    A player's rating is cached when he enqueues, pairing never reads the database.
+    """
+
+    def __init__(self):
+        self.buckets = {}  # bucket -> OrderedDict of username -> WaitingPlayer
+        self.bucket_keys = []  # sorted keys of the non-empty buckets
+        self.players = {}
+
+    def __contains__(self, username):
+        return username in self.players
+
+    def __len__(self):
+        return len(self.players)
+
+    def add(self, username, rating, data=None, now=None):
+        if now is None:
+            now = time.monotonic()
+        player = WaitingPlayer(username, float(rating), now, data)
+        key = int(player.rating // BUCKET_SIZE)
+        if key not in self.buckets:
+            self.buckets[key] = OrderedDict()
+            insort(self.bucket_keys, key)
+        self.buckets[key][username] = player
+        self.players[username] = player
+
+    def remove(self, username) -> WaitingPlayer:
+        player = self.players.pop(username, None)
+        if player:
+            key = int(player.rating // BUCKET_SIZE)
+            bucket = self.buckets[key]
+            del bucket[username]
+            if not bucket:
+                del self.buckets[key]
+                del self.bucket_keys[bisect_left(self.bucket_keys, key)]
+        return player
+
+    def find_opponent(self, rating, window, now=None, exclude=None) -> WaitingPlayer:
+        """
+        Finds the closest rated waiting player that accepts the given rating (the wider window
+        of the two players counts, the oldest wins a tie). The nearest buckets are checked first,
+        and the walk stops once no bucket left can hold a closer player.
+        Returns: the opponent (WaitingPlayer), or None if no one is within reach
+        """
+        if now is None:
+            now = time.monotonic()
+        rating = float(rating)
+        high = bisect_left(self.bucket_keys, int(rating // BUCKET_SIZE))
+        low = high - 1
+        best, best_distance = None, MAX_WINDOW
+        while low >= 0 or high < len(self.bucket_keys):
+            low_gap = get_bucket_gap(rating, self.bucket_keys[low]) if low >= 0 else float('inf')
+            high_gap = get_bucket_gap(rating, self.bucket_keys[high]) if high < len(self.bucket_keys) else float('inf')
+            if min(low_gap, high_gap) > best_distance:
+                break
+            if low_gap <= high_gap:
+                bucket = self.buckets[self.bucket_keys[low]]
+                low -= 1
+            else:
+                bucket = self.buckets[self.bucket_keys[high]]
+                high += 1
+            for player in bucket.values():
+                distance = abs(player.rating - rating)
+                if player.username == exclude or distance > best_distance:
+                    continue
+                if best and distance == best_distance and player.since >= best.since:
+                    continue
+                if distance <= max(window, get_window(now - player.since)):
+                    best, best_distance = player, distance
+        return best
+
+    def pop_opponent(self, rating, now=None) -> WaitingPlayer:
+        opponent = self.find_opponent(rating, BASE_WINDOW, now)
+        if opponent:
+            self.remove(opponent.username)
+        return opponent
+
+    def match_waiting(self, now=None) -> list:
+        """
+        Pairs players that already wait, as their windows widen over time.
+        Returns: list of (player, opponent) pairs (WaitingPlayer), removed from the queue
+        """
+        if now is None:
+            now = time.monotonic()
+        pairs = []
+        for key in list(self.bucket_keys):
+            bucket = self.buckets.get(key)
+            if not bucket:
+                continue
+            player = next(iter(bucket.values()))
+            opponent = self.find_opponent(player.rating, get_window(now - player.since), now, player.username)
+            if opponent:
+                self.remove(player.username)
+                self.remove(opponent.username)
+                pairs.append((player, opponent))
+        return pairs
@@ -0,0 +1,106 @@
+import time
+
+IP_BUDGET = 'ip'
+MOVE_BUDGET = 'move'
+REQUEST_BUDGET = 'request'
+EXPENSIVE_BUDGET = 'expensive'
+LOGIN_BUDGET = 'login'
+LOGIN_IP_BUDGET = 'login_ip'
+
+# budget -> (tokens per second, burst size)
+BUDGETS = {
+    IP_BUDGET:          (20, 40),   # every message from an ip, shared by all of its connections (and NAT users)
+    MOVE_BUDGET:        (4, 10),    # moves of a single player
+    REQUEST_BUDGET:     (5, 10),    # any other cheap request of a single player
+    EXPENSIVE_BUDGET:   (0.2, 3),   # PvE (engine) requests of a single player
+    LOGIN_BUDGET:       (0.2, 3),   # logins and registrations of one username from one ip
+    LOGIN_IP_BUDGET:    (2, 20),    # all of them (and resumes) from one ip, many players may share it behind a NAT
+}
+IDLE_TIMEOUT = 300  # seconds a full bucket is kept before being dropped
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost, now) -> float:
+        """
+        Returns: seconds until the bucket holds `cost` tokens (0 if it already does)
+        """
+        self.refill(now)
+        if self.tokens >= cost:
+            return 0
+        return (cost - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    Token buckets of one budget, one bucket per key (ip or username).
+    Buckets refill lazily on the monotonic clock, so nothing has to be reset periodically.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets = {}
+
+    def _get_bucket(self, key, now) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.capacity, now)
+        return bucket
+
+    def wait_time(self, key, cost=1, now=None) -> float:
+        if now is None:
+            now = time.monotonic()
+        return self._get_bucket(key, now).wait_time(cost, now)
+
+    def consume(self, key, cost=1, now=None):
+        if now is None:
+            now = time.monotonic()
+        bucket = self._get_bucket(key, now)
+        bucket.refill(now)
+        bucket.tokens -= cost
+
+    def prune(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        for key in [key for key, bucket in self.buckets.items() if now - bucket.updated > IDLE_TIMEOUT]:
+            del self.buckets[key]
+
+
+LIMITERS = {budget: RateLimiter(rate, capacity) for budget, (rate, capacity) in BUDGETS.items()}
+
+
+def set_budget(budget, rate, capacity):
+    BUDGETS[budget] = (rate, capacity)
+    LIMITERS[budget] = RateLimiter(rate, capacity)
+
+
+def check(charges) -> float:
+    """
+    Gets a list of (budget, key) pairs a request is charged to.
+    The request is charged only if every bucket allows it.
+    Returns: 0 if the request may run now, otherwise seconds to wait before retrying it
+    """
+    now = time.monotonic()
+    wait = max(LIMITERS[budget].wait_time(key, now=now) for budget, key in charges)
+    if not wait:
+        for budget, key in charges:
+            LIMITERS[budget].consume(key, now=now)
+    return wait
+
+
+def prune():
+    now = time.monotonic()
+    for limiter in LIMITERS.values():
+        limiter.prune(now)
@@ -1,10 +1,12 @@
 import re
+import queue
 import chess.engine
+import chess.polyglot
 import chess
 from random import shuffle
-from stockfish import Stockfish
-import threading
+from collections import deque
 
+import chess_engines
 import os_values
 
 START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
@@ -65,6 +67,8 @@ class ChessRoom:
         self.turn = self.players[0]
         self.waiting = False
         self.level = engine_level
+        self.ponder_moves = {}  # zobrist hash of a position after a human reply -> engine answer
+        self.ponder_generation = 0  # bumped on every human move, stops a running ponder
 
     def __len__(self):
         return len(self.board.move_stack)
@@ -86,7 +90,54 @@ class ChessRoom:
         self.waiting = not self.waiting
 
 
-CHESS_ROOMS = []
+CHESS_ROOMS = set()
+PLAYER_ROOMS = {}  # player -> the room he is playing in
+ENGINE_PLAYER = 'stockfish'
+ENGINE_MOVE_CALLBACK = None
+ENGINE_DEPTH = 15  # depth of a full strength search, weaker levels search less
+ENGINE_MOVETIME = 2  # max seconds of a search
+LEVEL_NODES = 20000  # nodes searched per skill level
+MAX_QUEUED_SEARCHES = 64  # new PvE games are refused while more engine moves wait
+ENGINE_POOL = chess_engines.EnginePool(os_values.get_stockfish_path)
+ENGINE_SCHEDULER = chess_engines.EngineScheduler(ENGINE_POOL.size)
+MOVE_CACHE = chess_engines.MoveCache()
+MOVE_CACHE_FILE = None  # path the move cache is loaded from and saved to, None keeps it in memory only
+PONDER_ENABLED = False
+PONDER_REPLIES = 3  # most likely human replies searched ahead
+PONDER_DEPTH = 8  # depth of the search that predicts the human replies
+
+# rooms whose state changed and need the server's attention, filled by the game functions
+# (and engine threads) and drained by the server, so idle rooms are never looked at
+ROOM_EVENTS = deque()
+MOVE_COMMITTED = 'move_committed'
+ENGINE_MOVE_READY = 'engine_move_ready'
+ENGINE_TURN = 'engine_turn'
+OPPONENT_QUIT = 'opponent_quit'
+GAME_OVER = 'game_over'
+
+
+def _push_event(event, room):
+    ROOM_EVENTS.append((event, room))
+
+
+def pop_events() -> list:
+    events = []
+    while ROOM_EVENTS:
+        events.append(ROOM_EVENTS.popleft())
+    return events
+
+
+def is_room_open(room) -> bool:
+    return room in CHESS_ROOMS
+
+
+def set_engine_move_callback(callback):
+    """
+    callback is called (from the engine thread) every time an engine search ends,
+    so the server can react to the move right away.
+    """
+    global ENGINE_MOVE_CALLBACK
+    ENGINE_MOVE_CALLBACK = callback
 
 
 def quit_match(player):
@@ -96,6 +147,8 @@ def quit_match(player):
         room.turn = get_opponent(player)
         room.waiting = True
     room.players.remove(player)
+    del PLAYER_ROOMS[player]
+    _push_event(OPPONENT_QUIT, room)
 
 
 def did_opponent_quit(player):
@@ -103,7 +156,7 @@ def did_opponent_quit(player):
 
 
 def is_pvp_room(player):
-    return 'stockfish' not in _get_room(player).players
+    return ENGINE_PLAYER not in _get_room(player).players
 
 
 def get_fen(player):
@@ -140,6 +193,13 @@ def is_game_over(player) -> bool:
     return _get_room(player).board.result() != '*'
 
 
+def get_result(player) -> str:
+    """
+    Returns: the result from white's side ('1-0', '0-1', '1/2-1/2' or '*' if the game goes on)
+    """
+    return _get_room(player).board.result()
+
+
 def get_game_results(player) -> int:
     room = _get_room(player)
     if is_game_over(player):
@@ -162,54 +222,156 @@ def commit_move(player, move) -> bool:
     if not is_client_turn(player):
         return False, 'not your turn'
     room.board.push(chess.Move.from_uci(move))
+    room.ponder_generation += 1
     room.update_turn()
+    _push_event(GAME_OVER if room.board.is_game_over() else MOVE_COMMITTED, room)
     return True, ''
 
 
 def add_room(player1, player2='', fen=START_FEN, level=10) -> None:
-    global CHESS_ROOMS
     if player2:
-        CHESS_ROOMS.append(ChessRoom(player1, player2, fen))
+        room = ChessRoom(player1, player2, fen)
     else:
-        CHESS_ROOMS.append(ChessRoom(player1, 'stockfish', fen, int(level)))
+        room = ChessRoom(player1, ENGINE_PLAYER, fen, int(level))
+    CHESS_ROOMS.add(room)
+    for player in room.players:
+        if player != ENGINE_PLAYER:
+            PLAYER_ROOMS[player] = room
+    if room.turn == ENGINE_PLAYER:
+        room.update_status()
+        _push_event(ENGINE_TURN, room)
 
 
 def is_in_room(player) -> bool:
-    for room in CHESS_ROOMS:
-        if player in room.players:
-            return True
-    return False
+    return player in PLAYER_ROOMS
 
 
 def _get_room(player) -> ChessRoom:
-    for room in CHESS_ROOMS:
-        if player in room.players:
-            return room
-    return None
+    return PLAYER_ROOMS.get(player)
 
 
 def close_room(player) -> None:
-    global CHESS_ROOMS
-    CHESS_ROOMS.remove(_get_room(player))
+    room = PLAYER_ROOMS[player]
+    CHESS_ROOMS.discard(room)
+    for room_player in room.players:
+        if PLAYER_ROOMS.get(room_player) is room:
+            del PLAYER_ROOMS[room_player]
+
+
+def get_engine_limit(level) -> chess.engine.Limit:
+    """
+    weak levels play weak moves anyway, so they get a fraction of the full strength budget.
+    """
+    return chess.engine.Limit(depth=min(ENGINE_DEPTH, 5 + level // 2), nodes=LEVEL_NODES * (level + 1),
+                              time=ENGINE_MOVETIME)
+
+
+def is_engine_busy() -> bool:
+    return ENGINE_SCHEDULER.waiting(chess_engines.MOVE_PRIORITY) > MAX_QUEUED_SEARCHES
 
 
-def commit_engine_move(player):
-    global ANSWERED
+def search_engine_move(room, board) -> chess.Move:
+    with ENGINE_POOL.engine() as engine:
+        engine.configure({'Skill Level': room.level})
+        # passing the room as the game makes the engine get a ucinewgame when it switches games
+        result = engine.play(board, get_engine_limit(room.level), game=room)
+    return result.move
+
+
+def get_pondered_move(room, board) -> chess.Move:
+    move = room.ponder_moves.get(chess.polyglot.zobrist_hash(board))
+    room.ponder_moves.clear()
+    if move and move in board.legal_moves:
+        return move
+    return None
+
+
+def find_engine_move(room) -> chess.Move:
+    board = room.board.copy()
+    move = get_pondered_move(room, board) or MOVE_CACHE.get(board, room.level)
+    if move:
+        return move
+    try:
+        move = search_engine_move(room, board)
+    except (chess.engine.EngineError, chess.engine.EngineTerminatedError, TimeoutError):
+        # the crashed engine was dropped from the pool, the search runs again on a fresh one
+        move = search_engine_move(room, board)
+    MOVE_CACHE.add(board, room.level, move)
+    return move
+
+
+def is_ponder_stale(room, generation) -> bool:
+    return (ENGINE_SCHEDULER.waiting(chess_engines.MOVE_PRIORITY) > 0 or room.ponder_generation != generation
+            or not is_room_open(room))
+
+
+def ponder_replies(room, generation):
+    """
+    Runs while the human thinks: predicts his most likely replies and searches the engine's
+    answer to each, so the answer is ready when the reply arrives. Pondering only takes an idle
+    engine, runs after every queued engine move and stops as soon as the human moves or a real
+    engine move is requested.
+    """
+    board = room.board.copy()
+    try:
+        with ENGINE_POOL.engine(block=False) as engine:
+            engine.configure({'Skill Level': chess_engines.FULL_STRENGTH_LEVEL})
+            infos = engine.analyse(board, chess.engine.Limit(depth=PONDER_DEPTH), multipv=PONDER_REPLIES, game=room)
+            engine.configure({'Skill Level': room.level})
+            for info in infos:
+                if is_ponder_stale(room, generation):
+                    return
+                if not info.get('pv'):
+                    continue
+                board.push(info['pv'][0])
+                if not board.is_game_over():
+                    result = engine.play(board, get_engine_limit(room.level), game=room)
+                    room.ponder_moves[chess.polyglot.zobrist_hash(board)] = result.move
+                board.pop()
+    except (queue.Empty, chess.engine.EngineError, chess.engine.EngineTerminatedError, TimeoutError):
+        pass
+
+
+def commit_engine_move(room):
     try:
-        stockfish = Stockfish(os_values.get_stockfish_path())
-        room = _get_room(player)
-        fen = str(_get_room(player))
-        stockfish.set_skill_level(room.level)
-        stockfish.set_fen_position(fen)
-        room.board.push(chess.Move.from_uci(stockfish.get_best_move()))
+        move = find_engine_move(room)
+        room.board.push(move)
         room.update_turn()
+        _push_event(GAME_OVER if room.board.is_game_over() else ENGINE_MOVE_READY, room)
     except:
         pass
+    finally:
+        if ENGINE_MOVE_CALLBACK:
+            ENGINE_MOVE_CALLBACK()
+    if PONDER_ENABLED and not room.board.is_game_over():
+        ENGINE_SCHEDULER.submit(chess_engines.PONDER_PRIORITY, ponder_replies, room, room.ponder_generation)
 
 
 def get_engine_move(player):
     update_status(player)
-    threading.Thread(target=commit_engine_move, args=(player, )).start()
+    ENGINE_SCHEDULER.submit(chess_engines.MOVE_PRIORITY, commit_engine_move, _get_room(player))
+
+
+def set_engine_share(workers_count):
+    """
+    every server worker runs its own pool, the cores are split between them.
+    called before the first engine is started.
+    """
+    size = max(1, chess_engines.POOL_SIZE // workers_count)
+    ENGINE_POOL.size = size
+    ENGINE_SCHEDULER.workers = size
+
+
+def load_move_cache():
+    if MOVE_CACHE_FILE:
+        MOVE_CACHE.load(MOVE_CACHE_FILE)
+
+
+def close_engines():
+    ENGINE_SCHEDULER.close()
+    ENGINE_POOL.close()
+    if MOVE_CACHE_FILE:
+        MOVE_CACHE.save(MOVE_CACHE_FILE)
 
 
 def update_status(player):
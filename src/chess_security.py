@@ -0,0 +1,115 @@
+import ipaddress
+import time
+from collections import OrderedDict
+
+NEVER = float('inf')  # ttl of entries that never expire
+
+
+class ExpiringTable:
+    """
+    Dict-like table whose entries expire after a ttl. It holds at most max_size entries,
+    when it is full the least recently used entry is evicted, so its memory stays flat
+    no matter how many keys are added (for example during a scan).
+    """
+
+    _MISSING = object()
+
+    def __init__(self, ttl=NEVER, max_size=100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()  # key -> (value, expiry time), least recently used first
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        self.entries[key] = (value, time.monotonic() + ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        value, expiry = entry
+        if expiry <= time.monotonic():
+            del self.entries[key]
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def pop(self, key, default=None):
+        value = self.get(key, self._MISSING)
+        if value is self._MISSING:
+            return default
+        del self.entries[key]
+        return value
+
+    def prune(self):
+        now = time.monotonic()
+        for key in [key for key, (value, expiry) in self.entries.items() if expiry <= now]:
+            del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self._MISSING) is not self._MISSING
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class BlackList:
+    """
+    Expiring set of blocked ip addresses and networks (CIDR, e.g. '10.0.0.0/8').
+    Networks are kept in one table per prefix length, so a lookup costs a dict lookup per
+    prefix length in use instead of a scan over every entry.
+    """
+
+    def __init__(self, ttl=NEVER, max_size=100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.addresses = ExpiringTable(ttl, max_size)
+        self.networks = {}  # (ip version, prefix length) -> ExpiringTable of network addresses (int)
+
+    def add(self, entry, ttl=None):
+        network = ipaddress.ip_network(entry, strict=False)
+        if network.num_addresses == 1:
+            self.addresses.set(str(network.network_address), True, ttl)
+            return
+        key = (network.version, network.prefixlen)
+        if key not in self.networks:
+            self.networks[key] = ExpiringTable(self.ttl, self.max_size)
+        self.networks[key].set(int(network.network_address), True, ttl)
+
+    def remove(self, entry):
+        network = ipaddress.ip_network(entry, strict=False)
+        if network.num_addresses == 1:
+            self.addresses.pop(str(network.network_address))
+        elif (network.version, network.prefixlen) in self.networks:
+            self.networks[(network.version, network.prefixlen)].pop(int(network.network_address))
+
+    def prune(self):
+        self.addresses.prune()
+        for table in self.networks.values():
+            table.prune()
+
+    def __contains__(self, ip):
+        if ip in self.addresses:
+            return True
+        if not self.networks:
+            return False
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        for (version, prefix_length), table in self.networks.items():
+            if version == address.version:
+                host_bits = address.max_prefixlen - prefix_length
+                if int(address) >> host_bits << host_bits in table:
+                    return True
+        return False
+
+    def __len__(self):
+        return len(self.addresses) + sum(len(table) for table in self.networks.values())
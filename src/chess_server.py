@@ -1,17 +1,27 @@
 ##############################################################################
 #                                server.py                                   #
 ##############################################################################
+import os
 import socket
+import sys
 import threading
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
 
 import chess_chatlib as chatlib
-import select
+import selectors
 import traceback
 import logging
 import chess_rooms
+import chess_connections
+import chess_sessions
+import chess_accounts
+import chess_leaderboard
+import chess_cluster
+import chess_rate_limit
+import chess_security
+import chess_timers
 import time
-from datetime import datetime
 import re
 import handle_database as hd
 
@@ -19,39 +29,62 @@ import handle_database as hd
 import os_values
 
 EXECUTOR = ThreadPoolExecutor(max_workers=10)
-CLIENT_SOCKETS = []
-BLACK_LIST = []
-MSG_COUNT = {}
-FAILED_LOGIN = {}
-LAST_COUNT_RESET = datetime.now()
+SELECTOR = None
+WAKER = None
+COORDINATOR = chess_cluster.LocalCoordinator()
+WORKER_ID = chess_cluster.LOCAL_WORKER
+WORKERS_COUNT = 1
+TIMERS = chess_timers.TimerQueue()
+OUTBOX = deque()
+CONNECTIONS_TO_FLUSH = set()
+OUTPUT_HIGH_WATERMARK = 64 * 1024
+MAX_PENDING_OUTPUT = 1024 * 1024
+CONNECTIONS = {}
+IP_CONNECTIONS = {}
+MAX_CONNECTIONS_PER_IP = 5
+BLACK_LIST_TTL = 60 * 60
+FAILED_LOGIN_TTL = 15 * 60
+MAX_SECURITY_ENTRIES = 100000
+BLOCKED_NETWORKS = []  # CIDR ranges blocked for good, e.g. '203.0.113.0/24'
+BLACK_LIST = chess_security.BlackList(BLACK_LIST_TTL, MAX_SECURITY_ENTRIES)
+FAILED_LOGIN = chess_security.ExpiringTable(FAILED_LOGIN_TTL, MAX_SECURITY_ENTRIES)
+THROTTLED = {}  # socket -> timer that runs its deferred messages
+PRUNE_INTERVAL = 60
+ENGINE_STATS_INTERVAL = 300
+LEADERBOARD_RELOAD_INTERVAL = 10 * 60  # with several workers, each one sees the others' games on reload
+DEFAULT_TOP_PLAYERS = 10
+DEFAULT_AROUND_PLAYERS = 5
+LOGIN_TIMEOUT = 2 * 60  # seconds a client may stay connected without logging in
+IDLE_TIMEOUT = 30 * 60  # seconds a logged client that isn't playing may stay silent
+WAITING_TIMEOUT = 60
+HANDOFF_TIMEOUT = 5
+RESUME_GRACE = 60  # seconds a lost connection's session (and game) can be resumed
+EXPENSIVE_COMMANDS = [chatlib.PROTOCOL_CLIENT["single-player"]]
+LOGIN_COMMANDS = [chatlib.PROTOCOL_CLIENT["login_msg"], chatlib.PROTOCOL_CLIENT["first_login_msg"],
+                  chatlib.PROTOCOL_CLIENT["resume_msg"]]
 START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
-MESSAGES_TO_SEND = []
-LOGGED_USERS_CONN = {}
-WAITING_ROOM = {}
+WAITING_ROOM = {}  # username -> timeout timer
 OPPONENT_QUIT_DURING_TURN = []
 CREATION_THREAD = []
 ERROR_MSG = "Error!"
 SERVER_PORT = 5678
 SERVER_IP = "0.0.0.0"
 MAX_MSG_SIZE = 1024
+RECV_SIZE = 65536
 
 
 def get_username(conn):
-    for username, connection in LOGGED_USERS_CONN.items():
-        if conn == connection:
-            return username
-    return None
+    return chess_sessions.get_username(conn)
 
 
 def get_conn(username):
-    return LOGGED_USERS_CONN[username]
+    return chess_sessions.get_conn(username)
 
 
 def print_log(conn, msg, from_client=True):
     spaces = 15
-    if conn in LOGGED_USERS_CONN.values():
-        player = get_username(conn)
-    else:
+    player = get_username(conn)
+    if player is None:
         player = get_ip(conn)
     text = 'sending to'
     if from_client:
@@ -60,16 +93,48 @@ def print_log(conn, msg, from_client=True):
 
 
 def build_and_send_message(conn, code, data):
-    global MESSAGES_TO_SEND
     msg = chatlib.build_message(code, data)
-    MESSAGES_TO_SEND.append((conn, msg))
+    if threading.current_thread() is threading.main_thread():
+        queue_message(conn, msg)
+    else:
+        OUTBOX.append((conn, msg))
+        WAKER.wake()
+
+
+def queue_message(conn, msg):
+    if conn not in CONNECTIONS:
+        return
+    print_log(conn, msg, from_client=False)
+    CONNECTIONS[conn].queue_message(msg.encode())
+    session = chess_sessions.get_session(conn)
+    if session:
+        session.messages_sent += 1
+    CONNECTIONS_TO_FLUSH.add(conn)
 
 
-def recv_message_and_parse(conn):
-    full_msg = conn.recv(MAX_MSG_SIZE).decode()
-    cmd, data = chatlib.parse_message(full_msg)
-    print_log(conn, full_msg)
-    return cmd, data
+def recv_messages_and_parse(conn):
+    """
+    reads from the socket and parses every complete message buffered for it,
+    a corrupted stream or a closed connection ends the list with (None, None).
+    """
+    if not CONNECTIONS[conn].receive(RECV_SIZE):
+        return [(None, None)]
+    return parse_buffered_messages(conn)
+
+
+def parse_buffered_messages(conn):
+    connection = CONNECTIONS[conn]
+    parsed = []
+    full_messages, is_valid = connection.pop_messages(MAX_MSG_SIZE)
+    session = chess_sessions.get_session(conn)
+    if session:
+        session.messages_received += len(full_messages)
+    for full_msg in full_messages:
+        print_log(conn, full_msg)
+        parsed.append(chatlib.parse_message(full_msg))
+    if not is_valid:
+        parsed.append((None, None))
+    return parsed
 
 
 def setup_socket():
@@ -77,6 +142,8 @@ def setup_socket():
     while True:
         try:
             server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if WORKERS_COUNT > 1:
+                server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             server_socket.bind((SERVER_IP, SERVER_PORT))
             server_socket.listen()
             break
@@ -90,25 +157,191 @@ def send_error(conn, error_msg):
 
 
 def handle_get_rating_message(username):
-    rating = str(int(hd.get_elo(username)))
+    rating = str(int(chess_accounts.get_elo(username)))
     build_and_send_message(get_conn(username), chatlib.PROTOCOL_SERVER["get_rating_msg"], rating)
 
 
+def get_count(data, default):
+    if data.isdecimal():
+        return min(int(data), chess_leaderboard.MAX_LISTED_PLAYERS)
+    return default
+
+
+def join_ranking(ranking):
+    return chatlib.join_data([f"{rank},{username},{int(elo)}" for rank, username, elo in ranking])
+
+
+def handle_get_rank_message(username):
+    rank = chess_leaderboard.LEADERBOARD.rank(username)
+    data = chatlib.join_data([str(rank), str(len(chess_leaderboard.LEADERBOARD))])
+    build_and_send_message(get_conn(username), chatlib.PROTOCOL_SERVER["rank_msg"], data)
+
+
+def handle_top_players_message(username, data):
+    ranking = chess_leaderboard.LEADERBOARD.top(get_count(data, DEFAULT_TOP_PLAYERS))
+    build_and_send_message(get_conn(username), chatlib.PROTOCOL_SERVER["top_players_msg"], join_ranking(ranking))
+
+
+def handle_players_around_message(username, data):
+    ranking = chess_leaderboard.LEADERBOARD.around(username, get_count(data, DEFAULT_AROUND_PLAYERS))
+    build_and_send_message(get_conn(username), chatlib.PROTOCOL_SERVER["players_around_msg"], join_ranking(ranking))
+
+
 def handle_pvp_request_message(username):
-    global WAITING_ROOM
-    if WAITING_ROOM:
-        opponent = list(WAITING_ROOM.keys())[0]
-        chess_rooms.add_room(username, opponent)
-        del WAITING_ROOM[opponent]
-        w_player = chess_rooms.get_white_player(username)
-        msg = chatlib.PROTOCOL_SERVER["game_started_msg"]
-        build_and_send_message(get_conn(w_player), msg, chatlib.join_data(['white', START_FEN]))
-        build_and_send_message(get_conn(chess_rooms.get_opponent(w_player)), msg,
-                               chatlib.join_data(['black', START_FEN]))
-        hd.update_games_played(username, 1)
-        hd.update_games_played(opponent, 1)
+    pair = COORDINATOR.enqueue(username, chess_accounts.get_elo(username))
+    if pair is None:
+        leave_waiting_room(username)
+        WAITING_ROOM[username] = TIMERS.call_later(WAITING_TIMEOUT, waiting_timeout, username)
     else:
-        WAITING_ROOM[username] = datetime.now()
+        handle_pairing(username, *pair)
+
+
+def handle_pairing(username, opponent, worker):
+    leave_waiting_room(username)
+    if worker != WORKER_ID:
+        hand_off_client(username, opponent, worker)
+    elif opponent in WAITING_ROOM and chess_sessions.is_logged_in(opponent):
+        leave_waiting_room(opponent)
+        start_pvp_game(username, opponent)
+    else:
+        # the opponent logged out while the pairing was on its way
+        handle_pvp_request_message(username)
+
+
+def match_waiting_players():
+    for username, opponent, worker in COORDINATOR.match_waiting():
+        handle_pairing(username, opponent, worker)
+    TIMERS.call_later(chess_cluster.MATCH_INTERVAL, match_waiting_players)
+
+
+def leave_waiting_room(username):
+    TIMERS.cancel(WAITING_ROOM.pop(username, None))
+
+
+def waiting_timeout(username, is_paired=False):
+    if is_paired or COORDINATOR.dequeue(username):
+        del WAITING_ROOM[username]
+        build_and_send_message(get_conn(username), chatlib.PROTOCOL_SERVER["no_opponent_found_msg"], '')
+    else:
+        # an opponent was found on another worker and its client is moving here
+        WAITING_ROOM[username] = TIMERS.call_later(HANDOFF_TIMEOUT, waiting_timeout, username, True)
+
+
+def start_pvp_game(username, opponent):
+    chess_rooms.add_room(username, opponent)
+    w_player = chess_rooms.get_white_player(username)
+    msg = chatlib.PROTOCOL_SERVER["game_started_msg"]
+    build_and_send_message(get_conn(w_player), msg, chatlib.join_data(['white', START_FEN]))
+    build_and_send_message(get_conn(chess_rooms.get_opponent(w_player)), msg,
+                           chatlib.join_data(['black', START_FEN]))
+
+
+def hand_off_client(username, opponent, worker):
+    """
+    the opponent is connected to another worker, so the client's socket moves there
+    (along with its buffered input and output) and the game is played on that worker.
+    """
+    conn = get_conn(username)
+    if conn is None:
+        # the connection was lost, the opponent's wait times out
+        return
+    account = chess_accounts.get_account(username)
+    try:
+        # the other worker takes the account over, the database has to be up to date first
+        chess_accounts.flush()
+    except Exception:
+        build_and_send_message(conn, chatlib.PROTOCOL_SERVER["no_opponent_found_msg"], '')
+        return
+    if not pass_client(conn, worker, user=username, opponent=opponent,
+                       token=chess_sessions.get_user_session(username).token,
+                       elo=account.elo, games_played=account.games_played):
+        build_and_send_message(conn, chatlib.PROTOCOL_SERVER["no_opponent_found_msg"], '')
+        return
+    chess_sessions.remove_session(conn)
+    chess_accounts.remove_account(username)
+    print(f"{username} moved to worker {worker}")
+
+
+def pass_client(conn, worker, **state) -> bool:
+    """
+    passes the client's socket to another worker along with the state, the client's unread input,
+    queued output and deferred messages included. the queued output is flushed first, so only what
+    the socket didn't take has to travel.
+    Returns: False if the client stays here (its state is too big to pass along or the handoff failed)
+    """
+    connection = CONNECTIONS[conn]
+    try:
+        connection.flush()
+        state.update({'address': list(connection.address),
+                      'recv': connection.recv_buffer[connection.read_pos:].decode('latin-1'),
+                      'send': b''.join(connection.send_queue).decode('latin-1'),
+                      'deferred': connection.deferred_messages})
+        if not COORDINATOR.handoff(state, worker, conn.fileno()):
+            return False
+    except OSError as e:
+        print(f"passing a client to worker {worker} failed: {e}")
+        return False
+    detach_client(conn)
+    conn.close()
+    return True
+
+
+def forward_client(conn, username, token) -> bool:
+    """
+    a reconnect lands on any worker, when the player's session is held by another one the new
+    connection is handed to it. token is '' for a player that logged in with a password.
+    Returns: False if no other worker holds the session
+    """
+    if WORKERS_COUNT == 1:
+        return False
+    worker = COORDINATOR.locate(username)
+    if worker is None or worker == WORKER_ID:
+        return False
+    if not pass_client(conn, worker, user=username, resume=token):
+        return False
+    print(f"{username} reconnected, moved to worker {worker}")
+    return True
+
+
+def adopt_client(state, fd):
+    conn = socket.socket(fileno=fd)
+    register_client(conn, tuple(state['address']))
+    connection = CONNECTIONS[conn]
+    connection.recv_buffer += state['recv'].encode('latin-1')
+    if state['send']:
+        connection.queue_message(state['send'].encode('latin-1'))
+        CONNECTIONS_TO_FLUSH.add(conn)
+    # the messages held back while the client was throttled came before its unread input
+    messages = [tuple(message) for message in state['deferred']]
+    if 'resume' in state:
+        adopt_resuming_client(conn, state['user'], state['resume'], messages)
+        return
+    username, opponent = state['user'], state['opponent']
+    chess_sessions.add_session(username, conn, connection.ip, state['token'])
+    chess_accounts.add_account(username, state['elo'], state['games_played'])
+    print(f"{username} joined from another worker")
+    if opponent in WAITING_ROOM and chess_sessions.is_logged_in(opponent):
+        leave_waiting_room(opponent)
+        start_pvp_game(username, opponent)
+    else:
+        handle_pvp_request_message(username)
+    handle_messages(conn, messages + parse_buffered_messages(conn))
+
+
+def adopt_resuming_client(conn, username, token, messages):
+    """
+    the client reconnected on another worker to resume the session held here
+    """
+    if token:
+        handle_resume_message(conn, token, is_forwarded=True)
+    else:
+        session = chess_sessions.get_user_session(username)
+        if session and session.conn is None:
+            resume_session(conn, session)
+        else:
+            build_and_send_message(conn, chatlib.PROTOCOL_SERVER["login_failed_msg"], "user already logged in")
+    if conn in CONNECTIONS:
+        handle_messages(conn, messages + parse_buffered_messages(conn))
 
 
 def handle_pve_request_message(username, level):
@@ -116,24 +349,13 @@ def handle_pve_request_message(username, level):
     level_regex = '^(1?[0-9]|20)$'
     if not re.search(level_regex, level):
         build_and_send_message(get_conn(username), chatlib.PROTOCOL_SERVER['invalid_level'], '')
+    elif chess_rooms.is_engine_busy():
+        build_and_send_message(get_conn(username), chatlib.PROTOCOL_SERVER['server_busy_msg'], '')
     else:
         chess_rooms.add_room(username, level=level)
         color = color_dict[chess_rooms.color(username)]
         msg = chatlib.PROTOCOL_SERVER["game_started_msg"]
         build_and_send_message(get_conn(username), msg, chatlib.join_data([color, START_FEN]))
-        if chess_rooms.color(username):
-            chess_rooms.update_status(username)
-
-
-def check_waiting_room():
-    global WAITING_ROOM
-    waiting_users = list(WAITING_ROOM.keys())
-    for user in waiting_users:
-        now = datetime.now()
-        difference = now - WAITING_ROOM[user]
-        if difference.seconds > 60:
-            build_and_send_message(get_conn(user), chatlib.PROTOCOL_SERVER["no_opponent_found_msg"], '')
-            del WAITING_ROOM[user]
 
 
 def handle_move_message(username, data):
@@ -180,17 +402,27 @@ def update_quiting_status(user):
         chess_rooms.close_room(user)
 
 
+def update_player(user):
+    update_quiting_status(user)
+    if not chess_rooms.is_in_room(user):
+        return
+    if chess_rooms.is_game_over(user):
+        handle_game_over(user)
+    elif chess_rooms.is_waiting(user):
+        if chess_rooms.is_client_turn(user):
+            send_opponent_msg(user)
+        elif not chess_rooms.is_pvp_room(user):
+            chess_rooms.get_engine_move(user)
+
+
 def update_players():
-    for user, conn in LOGGED_USERS_CONN.items():
-        if chess_rooms.is_in_room(user):
-            update_quiting_status(user)
-            if chess_rooms.is_game_over(user):
-                handle_game_over(user)
-            elif chess_rooms.is_waiting(user):
-                if chess_rooms.is_client_turn(user):
-                    send_opponent_msg(user)
-                elif not chess_rooms.is_pvp_room(user):
-                    chess_rooms.get_engine_move(user)
+    """
+    only the rooms that reported a change since the last call are updated.
+    """
+    for event, room in chess_rooms.pop_events():
+        for user in list(room.players):
+            if chess_rooms.is_room_open(room) and chess_sessions.is_logged_in(user):
+                update_player(user)
 
 
 def game_update_req(username):
@@ -222,57 +454,112 @@ def handle_quit_msg(user):
 
 def update_elo(user, is_game_over=True):
     """
-    RatA + K * (score - (1 / (1 + 10(RatB - RatA)/400)))
-    K = 400/(games_played**1.5) + 16
+    settles the game, if it isn't over the user quit and lost it.
     """
-    p_username = user
-    o_username = chess_rooms.get_opponent(user)
-    p_elo = float(hd.get_elo(p_username))
-    o_elo = float(hd.get_elo(o_username))
-    p_K = 400 / (hd.get_games_played(p_username)) + 16
-    o_K = 400 / (hd.get_games_played(o_username)) + 16
-    if not is_game_over:
-        p_score = 0
-        o_score = 1
+    white = chess_rooms.get_white_player(user)
+    black = chess_rooms.get_opponent(white)
+    if is_game_over:
+        result = chess_rooms.get_result(user)
     else:
-        p_score = chess_rooms.get_game_results(user)
-        o_score = chess_rooms.get_game_results(chess_rooms.get_opponent(user))
-    p_new_elo = p_elo + p_K * (p_score - (1 / (1 + 10 ** ((o_elo - p_elo) / 400))))
-    o_new_elo = o_elo + o_K * (o_score - (1 / (1 + 10 ** ((p_elo - o_elo) / 400))))
-    hd.update_elo(p_username, p_new_elo)
-    hd.update_elo(o_username, o_new_elo)
+        result = '0-1' if user == white else '1-0'
+    chess_accounts.settle_game(white, black, result)
+
+
+def logout_user(username):
+    leave_waiting_room(username)
+    if chess_rooms.is_in_room(username):
+        handle_quit_msg(username)
+    session = chess_sessions.remove_user_session(username)
+    TIMERS.cancel(session.grace_timer)
+    chess_accounts.remove_account(username)
+    COORDINATOR.release(username)
 
 
 def handle_logout_message(conn):
-    global LOGGED_USERS_CONN, WAITING_ROOM
     user = get_ip(conn)
-    if conn in LOGGED_USERS_CONN.values():
+    if chess_sessions.is_conn_logged_in(conn):
         user = get_username(conn)
-        if user in list(WAITING_ROOM.keys()):
-            del WAITING_ROOM[user]
-        if chess_rooms.is_in_room(user):
-            handle_quit_msg(user)
-        del LOGGED_USERS_CONN[get_username(conn)]
+        logout_user(user)
     conn.close()
     print(f"connection to {user} closed")
 
 
+def drop_client(conn):
+    """
+    the connection was lost (not logged out), a logged-in player's session and game are kept
+    for RESUME_GRACE seconds so they can be resumed from a new connection.
+    """
+    session = chess_sessions.get_session(conn)
+    if session is None:
+        remove_client(conn)
+        return
+    detach_client(conn)
+    chess_sessions.suspend_session(conn)
+    conn.close()
+    session.grace_timer = TIMERS.call_later(RESUME_GRACE, end_suspended_session, session.username)
+    print(f"connection to {session.username} lost, waiting {RESUME_GRACE}s for a resume")
+
+
+def end_suspended_session(username):
+    session = chess_sessions.get_user_session(username)
+    if session and session.conn is None:
+        logout_user(username)
+        print(f"session of {username} expired")
+
+
+def resume_session(conn, session):
+    if session.conn is not None:
+        # the old connection is half open, the new one takes its place
+        old_conn = session.conn
+        chess_sessions.suspend_session(old_conn)
+        detach_client(old_conn)
+        old_conn.close()
+    TIMERS.cancel(session.grace_timer)
+    session.grace_timer = None
+    chess_sessions.attach_session(session, conn, get_ip(conn))
+    username = session.username
+    build_and_send_message(conn, chatlib.PROTOCOL_SERVER["login_ok_msg"], session.token)
+    if chess_rooms.is_in_room(username):
+        # the messages sent while the connection was lost are gone, the position is sent again
+        color = 'white' if chess_rooms.color(username) == 0 else 'black'
+        data = chatlib.join_data([color, chess_rooms.get_fen(username)])
+        build_and_send_message(conn, chatlib.PROTOCOL_SERVER["game_started_msg"], data)
+    print(f"{username} resumed the session")
+
+
+def handle_resume_message(conn, token, is_forwarded=False):
+    session = chess_sessions.get_token_session(token)
+    if session is not None:
+        resume_session(conn, session)
+    elif is_forwarded or not forward_client(conn, chess_sessions.get_token_username(token), token):
+        # not a failed login, a token only stops working when its session ended
+        build_and_send_message(conn, chatlib.PROTOCOL_SERVER["login_failed_msg"], "session expired")
+
+
 def handle_login_message(conn, data):
-    global LOGGED_USERS_NAMES, LOGGED_USERS_CONN
     data = chatlib.split_data(data, 2)
     if not data:
         build_and_send_message(conn, chatlib.PROTOCOL_SERVER["login_failed_msg"], "invalid value count")
         return
     username, password = data
-    if hd.does_username_exist(username):
-        if hd.check_password(username, password):
-            if username not in LOGGED_USERS_CONN.keys():
-                build_and_send_message(conn, chatlib.PROTOCOL_SERVER["login_ok_msg"], "")
-                LOGGED_USERS_CONN[username] = conn
+    login_data = hd.get_login_data(username)
+    if login_data is not None:
+        password_hash, elo, games_played = login_data
+        if hd.hash(password) == password_hash:
+            session = chess_sessions.get_user_session(username)
+            if session and session.conn is None:
+                resume_session(conn, session)
+                return
+            if not session and COORDINATOR.claim(username):
+                session = chess_sessions.add_session(username, conn, get_ip(conn))
+                build_and_send_message(conn, chatlib.PROTOCOL_SERVER["login_ok_msg"], session.token)
+                chess_accounts.add_account(username, elo, games_played)
                 hd.update_entry(username)
                 return
-            else:
-                build_and_send_message(conn, chatlib.PROTOCOL_SERVER["login_failed_msg"], "user already logged in")
+            if not session and forward_client(conn, username, ''):
+                # the player reconnected to another worker than the one holding the session
+                return
+            build_and_send_message(conn, chatlib.PROTOCOL_SERVER["login_failed_msg"], "user already logged in")
         else:
             build_and_send_message(conn, chatlib.PROTOCOL_SERVER["login_failed_msg"], "password incorrect")
     else:
@@ -306,6 +593,8 @@ def handle_unconnected_client(cmd, conn, data):
         build_and_send_message(conn, chatlib.PROTOCOL_SERVER["server_pending"], "creating account")
     elif cmd == chatlib.PROTOCOL_CLIENT["login_msg"]:
         handle_login_message(conn, data)
+    elif cmd == chatlib.PROTOCOL_CLIENT["resume_msg"]:
+        handle_resume_message(conn, data)
     elif cmd == chatlib.PROTOCOL_CLIENT["first_login_msg"]:
         handle_registration_message(conn, data)
     else:
@@ -314,7 +603,7 @@ def handle_unconnected_client(cmd, conn, data):
 
 def handle_client_message(conn, cmd, data):
     global OPPONENT_QUIT_DURING_TURN
-    if conn not in list(LOGGED_USERS_CONN.values()):
+    if not chess_sessions.is_conn_logged_in(conn):
         handle_unconnected_client(cmd, conn, data)
         return
     username = get_username(conn)
@@ -326,6 +615,12 @@ def handle_client_message(conn, cmd, data):
         game_update_req(username)
     elif cmd == chatlib.PROTOCOL_CLIENT["get_my_rating"]:
         handle_get_rating_message(username)
+    elif cmd == chatlib.PROTOCOL_CLIENT["get_my_rank"]:
+        handle_get_rank_message(username)
+    elif cmd == chatlib.PROTOCOL_CLIENT["get_top_players"]:
+        handle_top_players_message(username, data)
+    elif cmd == chatlib.PROTOCOL_CLIENT["get_players_around_me"]:
+        handle_players_around_message(username, data)
     elif cmd == chatlib.PROTOCOL_CLIENT["multiplayer"]:
         handle_pvp_request_message(username)
     elif cmd == chatlib.PROTOCOL_CLIENT["single-player"]:
@@ -335,7 +630,7 @@ def handle_client_message(conn, cmd, data):
 
 
 def handle_logged_message(user):
-    conn_list = list(LOGGED_USERS_CONN)
+    conn_list = list(chess_sessions.logged_users())
     logged = chatlib.join_data(conn_list)
     if len(logged) > 1:
         chatlib.join_data(logged)
@@ -343,12 +638,14 @@ def handle_logged_message(user):
 
 
 def print_client_sockets():
-    logged_list = list(LOGGED_USERS_CONN.keys())
+    logged_list = list(chess_sessions.logged_users())
     for c in logged_list:
         print(f"{c}\t")
 
 
 def get_ip(conn):
+    if conn in CONNECTIONS:
+        return CONNECTIONS[conn].ip
     try:
         ip = conn.getpeername()[0]
     except OSError:
@@ -356,116 +653,343 @@ def get_ip(conn):
     return ip
 
 
+def register_client(client_socket, client_address):
+    connection = chess_connections.ClientConnection(client_socket, client_address)
+    CONNECTIONS[client_socket] = connection
+    IP_CONNECTIONS.setdefault(connection.ip, set()).add(client_socket)
+    client_socket.setblocking(False)
+    # dead peers (dropped mobile connections etc.) are detected by TCP keepalive probes
+    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+    connection.events = selectors.EVENT_READ
+    SELECTOR.register(client_socket, connection.events, connection)
+    schedule_idle_check(client_socket, connection.connected_at + LOGIN_TIMEOUT)
+
+
+def detach_client(conn):
+    connection = CONNECTIONS.pop(conn, None)
+    if connection:
+        if connection.events:
+            SELECTOR.unregister(conn)
+        CONNECTIONS_TO_FLUSH.discard(conn)
+        TIMERS.cancel(THROTTLED.pop(conn, None))
+        TIMERS.cancel(connection.idle_timer)
+        ip_connections = IP_CONNECTIONS[connection.ip]
+        ip_connections.discard(conn)
+        if not ip_connections:
+            del IP_CONNECTIONS[connection.ip]
+
+
+def remove_client(conn):
+    detach_client(conn)
+    handle_logout_message(conn)
+
+
 def update_black_list(client_conn: socket.socket):
-    global BLACK_LIST, CLIENT_SOCKETS
-    ip = get_ip(client_conn)
-    handle_logout_message(client_conn)
-    CLIENT_SOCKETS.remove(client_conn)
-    BLACK_LIST.append(ip)
-    temp = CLIENT_SOCKETS.copy()
-    for conn in temp:
-        if get_ip(conn) == ip:
-            handle_logout_message(conn)
-            CLIENT_SOCKETS.remove(conn)
-
-
-def update_msg_follow():
-    global MSG_COUNT, LAST_COUNT_RESET
-    now = datetime.now()
-    difference = now - LAST_COUNT_RESET
-    if difference.seconds > 1:
-        MSG_COUNT = {}
-        LAST_COUNT_RESET = datetime.now()
-
-
-def msg_count_update(client_conn: socket.socket):
-    global MSG_COUNT
     ip = get_ip(client_conn)
-    if ip in MSG_COUNT:
-        MSG_COUNT[ip] += 1
-        if MSG_COUNT[ip] > 5:
-            update_black_list(client_conn)
-            return True
+    BLACK_LIST.add(ip)
+    if client_conn not in CONNECTIONS:
+        client_conn.close()
+    for conn in list(IP_CONNECTIONS.get(ip, ())):
+        remove_client(conn)
+
+
+def get_rate_limit_wait(conn, cmd, data):
+    """
+    every message is charged to its ip and to the player's budget for that kind of command
+    (unconnected clients are charged by ip). logins are charged to the username they claim, so
+    players behind one NAT don't wait for each other, and to a wider budget of the ip. resume
+    tokens can't be guessed, so a resume is charged to the ip's budget only.
+    returns: seconds the message has to wait, 0 if it can be handled now
+    """
+    ip = get_ip(conn)
+    player = get_username(conn)
+    if cmd in LOGIN_COMMANDS and not player:
+        charges = [(chess_rate_limit.IP_BUDGET, ip), (chess_rate_limit.LOGIN_IP_BUDGET, ip)]
+        if cmd != chatlib.PROTOCOL_CLIENT["resume_msg"]:
+            username = data.partition(chatlib.DATA_DELIMITER)[0]
+            charges.append((chess_rate_limit.LOGIN_BUDGET, (ip, username)))
+        return chess_rate_limit.check(charges)
+    player = player or ip
+    if cmd in EXPENSIVE_COMMANDS or cmd in LOGIN_COMMANDS:
+        budget = chess_rate_limit.EXPENSIVE_BUDGET
+    elif cmd == chatlib.PROTOCOL_CLIENT["my_move_msg"]:
+        budget = chess_rate_limit.MOVE_BUDGET
     else:
-        MSG_COUNT[ip] = 1
-    return False
-            
+        budget = chess_rate_limit.REQUEST_BUDGET
+    return chess_rate_limit.check([(chess_rate_limit.IP_BUDGET, ip), (budget, player)])
+
+
+def throttle_client(conn, messages, wait):
+    """
+    instead of dropping (or banning) a client that is over its budget, its messages are kept
+    and it isn't read from until they can run.
+    """
+    CONNECTIONS[conn].deferred_messages = messages
+    THROTTLED[conn] = TIMERS.call_later(wait, resume_throttled_client, conn)
+    update_events(conn)
+
+
+def resume_throttled_client(conn):
+    del THROTTLED[conn]
+    connection = CONNECTIONS[conn]
+    messages, connection.deferred_messages = connection.deferred_messages, []
+    update_events(conn)
+    handle_messages(conn, messages)
+
+
+def prune_tables():
+    chess_rate_limit.prune()
+    BLACK_LIST.prune()
+    FAILED_LOGIN.prune()
+    TIMERS.call_later(PRUNE_INTERVAL, prune_tables)
+
+
+def flush_accounts():
+    try:
+        chess_accounts.flush()
+    except Exception as e:
+        print(f"writing the accounts failed, retrying later: {e}")
+    TIMERS.call_later(chess_accounts.FLUSH_INTERVAL, flush_accounts)
+
+
+def load_leaderboard():
+    chess_leaderboard.LEADERBOARD.load(hd.get_all_ratings())
+    # the games settled here but not written yet
+    for account in chess_accounts.ACCOUNTS.values():
+        chess_leaderboard.LEADERBOARD.update(account.username, account.elo)
+
+
+def reload_leaderboard():
+    try:
+        load_leaderboard()
+    except Exception as e:
+        print(f"reloading the leaderboard failed: {e}")
+    TIMERS.call_later(LEADERBOARD_RELOAD_INTERVAL, reload_leaderboard)
+
+
+def log_engine_stats():
+    stats = chess_rooms.ENGINE_SCHEDULER.stats()
+    print(f"engine queue: {stats['queued']} waiting ({stats['queued_moves']} moves), {stats['running']} running, "
+          f"{stats['completed']} done, average wait {stats['average_wait']:.3f}s, max wait {stats['max_wait']:.3f}s")
+    TIMERS.call_later(ENGINE_STATS_INTERVAL, log_engine_stats)
+
+
+def schedule_idle_check(conn, deadline):
+    CONNECTIONS[conn].idle_timer = TIMERS.call_at(deadline, check_idle_client, conn)
+
+
+def check_idle_client(conn):
+    """
+    clients that don't log in, or stay silent while not playing, are disconnected.
+    the timer isn't moved on every message, when it fires it is set again from the last activity.
+    """
+    connection = CONNECTIONS[conn]
+    username = get_username(conn)
+    timeout = IDLE_TIMEOUT if username else LOGIN_TIMEOUT
+    now = time.monotonic()
+    if username and (username in WAITING_ROOM or chess_rooms.is_in_room(username)):
+        schedule_idle_check(conn, now + timeout)
+    elif now - connection.last_activity >= timeout:
+        print(f"connection to {username or connection.ip} is idle")
+        remove_client(conn)
+    else:
+        schedule_idle_check(conn, connection.last_activity + timeout)
+
 
 def failed_login_update(client_conn: socket.socket):
-    global FAILED_LOGIN
     ip = get_ip(client_conn)
-    if ip in FAILED_LOGIN:
-        FAILED_LOGIN[ip] += 1
-        if FAILED_LOGIN[ip] > 3:
-            update_black_list(client_conn)
-            del FAILED_LOGIN[ip]
-            return True
-    else:
-        FAILED_LOGIN[ip] = 1
+    failed_count = FAILED_LOGIN.get(ip, 0) + 1
+    if failed_count > 3:
+        update_black_list(client_conn)
+        FAILED_LOGIN.pop(ip)
+        return True
+    FAILED_LOGIN.set(ip, failed_count)
     return False
 
 
-def main():
-    global MESSAGES_TO_SEND, BLACK_LIST, CLIENT_SOCKETS
-    print("Welcome to chess Server!")
+def accept_client(server_socket):
+    client_socket, client_address = server_socket.accept()
+    ip = client_address[0]
+    if ip in BLACK_LIST:
+        client_socket.close()
+    elif len(IP_CONNECTIONS.get(ip, ())) < MAX_CONNECTIONS_PER_IP:
+        print("new client joined!", client_address)
+        register_client(client_socket, client_address)
+    else:
+        update_black_list(client_socket)
+
+
+def handle_readable_client(current_socket):
+    if get_ip(current_socket) in BLACK_LIST:
+        remove_client(current_socket)
+        return
+    try:
+        messages = recv_messages_and_parse(current_socket)
+    except BlockingIOError:
+        return
+    except OSError:
+        drop_client(current_socket)
+        return
+    handle_messages(current_socket, messages)
+
+
+def handle_messages(current_socket, messages):
+    for i, (cmd, data) in enumerate(messages):
+        if cmd == chatlib.PROTOCOL_CLIENT["logout_msg"]:
+            remove_client(current_socket)
+            return
+        if cmd == "" or cmd is None:
+            drop_client(current_socket)
+            return
+        wait = get_rate_limit_wait(current_socket, cmd, data)
+        if wait:
+            throttle_client(current_socket, messages[i:], wait)
+            return
+        handle_client_message(current_socket, cmd, data)
+        if current_socket not in CONNECTIONS:
+            return
+
+
+def update_events(conn):
+    """
+    a socket is watched for writing only while it has queued output (idle sockets are always
+    writable), and reading from a client that doesn't read its replies is paused until
+    its queue drops below OUTPUT_HIGH_WATERMARK (or while it is throttled).
+    """
+    connection = CONNECTIONS[conn]
+    events = 0
+    if connection.pending_bytes <= OUTPUT_HIGH_WATERMARK and conn not in THROTTLED:
+        events |= selectors.EVENT_READ
+    if connection.send_queue:
+        events |= selectors.EVENT_WRITE
+    if events == connection.events:
+        return
+    if not events:
+        SELECTOR.unregister(conn)
+    elif not connection.events:
+        SELECTOR.register(conn, events, connection)
+    else:
+        SELECTOR.modify(conn, events, connection)
+    connection.events = events
+
+
+def send_pending(conn):
+    connection = CONNECTIONS[conn]
+    try:
+        connection.flush()
+    except OSError:
+        drop_client(conn)
+        return
+    if connection.pending_bytes > MAX_PENDING_OUTPUT:
+        print(f"connection to {get_ip(conn)} is too slow")
+        remove_client(conn)
+    else:
+        update_events(conn)
+
+
+def flush_connections():
+    while OUTBOX:
+        queue_message(*OUTBOX.popleft())
+    while CONNECTIONS_TO_FLUSH:
+        conn = CONNECTIONS_TO_FLUSH.pop()
+        if conn in CONNECTIONS:
+            send_pending(conn)
+
+
+def handle_cluster_message():
+    msg, fd = COORDINATOR.receive_push()
+    if msg['op'] == 'adopt':
+        adopt_client(msg['state'], fd)
+    elif msg['op'] == 'paired' and msg['user'] in WAITING_ROOM:
+        handle_pairing(msg['user'], msg['opponent'], msg['worker'])
+
+
+def run_server():
+    global SELECTOR, WAKER
+    SELECTOR = selectors.DefaultSelector()
+    WAKER = chess_connections.Waker()
     server_socket = setup_socket()
-    os_values.set_user()
-    hd.reset_table()
+    SELECTOR.register(server_socket, selectors.EVENT_READ)
+    SELECTOR.register(WAKER, selectors.EVENT_READ, WAKER)
+    if WORKERS_COUNT > 1:
+        SELECTOR.register(COORDINATOR, selectors.EVENT_READ, COORDINATOR)
+    chess_rooms.set_engine_move_callback(WAKER.wake)
+    chess_rooms.set_engine_share(WORKERS_COUNT)
+    chess_rooms.load_move_cache()
+    load_leaderboard()
+    for network in BLOCKED_NETWORKS:
+        BLACK_LIST.add(network, chess_security.NEVER)
+    TIMERS.call_later(PRUNE_INTERVAL, prune_tables)
+    TIMERS.call_later(ENGINE_STATS_INTERVAL, log_engine_stats)
+    TIMERS.call_later(chess_accounts.FLUSH_INTERVAL, flush_accounts)
+    if WORKERS_COUNT == 1:
+        # in supervisor mode the supervisor pairs waiting players
+        TIMERS.call_later(chess_cluster.MATCH_INTERVAL, match_waiting_players)
+    else:
+        TIMERS.call_later(LEADERBOARD_RELOAD_INTERVAL, reload_leaderboard)
     print("listening for clients...")
     try:
         while True:
-            check_waiting_room()
+            TIMERS.run_due()
             update_players()
-            update_msg_follow()
-            ready_to_read, ready_to_write, in_error = select.select([server_socket] + CLIENT_SOCKETS, CLIENT_SOCKETS, [])
-            for current_socket in ready_to_read:
-                if current_socket is server_socket:
-                    (client_socket, client_address) = current_socket.accept()
-                    ip = get_ip(client_socket)
-                    if ip in BLACK_LIST:
-                        client_socket.close()
-                    else:
-                        count = len(list(filter(lambda obj: get_ip(obj) == ip, CLIENT_SOCKETS)))
-                        if count < 5:
-                            print("new client joined!", client_address)
-                            CLIENT_SOCKETS.append(client_socket)
-                        else:
-                            update_black_list(client_socket)
-                else:
-                    if get_ip(current_socket) in BLACK_LIST:
-                        continue
-                    try:
-                        cmd, data = recv_message_and_parse(current_socket)
-                    except ConnectionResetError:
-                        CLIENT_SOCKETS.remove(current_socket)
-                        handle_logout_message(current_socket)
-                    else:
-                        if msg_count_update(current_socket):
-                            continue
-                        if cmd == "" or cmd is None or cmd == chatlib.PROTOCOL_CLIENT["logout_msg"]:
-                            CLIENT_SOCKETS.remove(current_socket)
-                            handle_logout_message(current_socket)
-                        else:
-                            handle_client_message(current_socket, cmd, data)
-            for message in MESSAGES_TO_SEND:
-                conn, data = message
-                try:
-                    if get_ip(conn) in BLACK_LIST:
-                        MESSAGES_TO_SEND.remove(message)
-                    elif conn in ready_to_write:
-                        conn.send(data.encode())
-                        print_log(conn, data, from_client=False)
-                        MESSAGES_TO_SEND.remove(message)
-                except OSError:
-                    MESSAGES_TO_SEND.remove(message)
+            flush_connections()
+            for key, mask in SELECTOR.select(TIMERS.get_timeout()):
+                if key.data is None:
+                    accept_client(key.fileobj)
+                    continue
+                if key.data is WAKER:
+                    WAKER.drain()
+                    continue
+                if key.data is COORDINATOR:
+                    handle_cluster_message()
+                    continue
+                if key.fileobj in CONNECTIONS and mask & selectors.EVENT_READ:
+                    handle_readable_client(key.fileobj)
+                if key.fileobj in CONNECTIONS and mask & selectors.EVENT_WRITE:
+                    send_pending(key.fileobj)
     except:
+        SELECTOR.close()
+        WAKER.close()
+        chess_rooms.close_engines()
         server_socket.close()
-        os_values.DB_CONN.close()
+        try:
+            chess_accounts.flush()
+        except Exception:
+            print("the last rating changes couldn't be written")
+        os_values.close_database_conn()
         print("\nserver crash due to an unexpected error as shown below")
         logging.error(traceback.format_exc())
 
 
-if __name__ == '__main__':
-    main()
+def run_worker(coordinator):
+    global COORDINATOR, WORKER_ID
+    COORDINATOR = coordinator
+    WORKER_ID = coordinator.worker
+    os_values.set_database_conn()
+    run_server()
 
 
+def main():
+    global WORKERS_COUNT
+    print("Welcome to chess Server!")
+    if len(sys.argv) > 1 and sys.argv[1].isdecimal():
+        WORKERS_COUNT = int(sys.argv[1])
+    if WORKERS_COUNT > 1 and not hasattr(os, 'fork'):
+        print("several workers need fork, running a single server")
+        WORKERS_COUNT = 1
+    os_values.set_user()
+    hd.reset_table()
+    if WORKERS_COUNT > 1:
+        # every worker opens its own database connection after the fork
+        os_values.close_database_conn()
+        chess_cluster.Supervisor(WORKERS_COUNT, run_worker).run()
+    else:
+        run_server()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import secrets
+import time
+from datetime import datetime
+
+TOKEN_BYTES = 24
+TOKEN_TTL = 24 * 60 * 60  # seconds a resume token stays valid
+TOKEN_SEPARATOR = '.'
+
+
+class Session:
+
+    def __init__(self, username, conn, ip):
+        self.username = username
+        self.conn = conn
+        self.ip = ip
+        self.login_time = datetime.now()
+        self.messages_received = 0
+        self.messages_sent = 0
+        self.token = None
+        self.token_expiry = 0
+        self.grace_timer = None  # set while the connection is lost and the session waits for a resume
+
+    def __repr__(self):
+        return f'Session({self.username}, {self.ip})'
+
+
+# every logged-in session is indexed both ways, so going from a socket to its
+# player (and back) never depends on how many players are logged in
+SESSIONS_BY_CONN = {}
+SESSIONS_BY_USER = {}
+SESSIONS_BY_TOKEN = {}
+
+
+def _issue_token(session, token=None):
+    SESSIONS_BY_TOKEN.pop(session.token, None)
+    # the username is in the clear so any worker can tell which one holds the session
+    session.token = token or f'{session.username}{TOKEN_SEPARATOR}{secrets.token_urlsafe(TOKEN_BYTES)}'
+    session.token_expiry = time.monotonic() + TOKEN_TTL
+    SESSIONS_BY_TOKEN[session.token] = session
+
+
+def add_session(username, conn, ip, token=None) -> Session:
+    session = Session(username, conn, ip)
+    SESSIONS_BY_CONN[conn] = session
+    SESSIONS_BY_USER[username] = session
+    _issue_token(session, token)
+    return session
+
+
+def remove_session(conn) -> Session:
+    session = SESSIONS_BY_CONN.pop(conn, None)
+    if session:
+        del SESSIONS_BY_USER[session.username]
+        SESSIONS_BY_TOKEN.pop(session.token, None)
+    return session
+
+
+def remove_user_session(username) -> Session:
+    session = SESSIONS_BY_USER.pop(username, None)
+    if session:
+        SESSIONS_BY_CONN.pop(session.conn, None)
+        SESSIONS_BY_TOKEN.pop(session.token, None)
+    return session
+
+
+def suspend_session(conn) -> Session:
+    """
+    detaches the session from its lost connection, the player stays logged in until
+    the session is resumed from another connection (or the server ends it).
+    """
+    session = SESSIONS_BY_CONN.pop(conn, None)
+    if session:
+        session.conn = None
+    return session
+
+
+def get_token_session(token) -> Session:
+    session = SESSIONS_BY_TOKEN.get(token)
+    if session and session.token_expiry <= time.monotonic():
+        return None
+    return session
+
+
+def get_token_username(token):
+    """
+    Returns: the username the token was issued to (the token may not be valid)
+    """
+    return token.partition(TOKEN_SEPARATOR)[0]
+
+
+def attach_session(session, conn, ip):
+    """
+    moves the session to a new connection, the resume token is replaced.
+    """
+    session.conn = conn
+    session.ip = ip
+    SESSIONS_BY_CONN[conn] = session
+    _issue_token(session)
+
+
+def get_session(conn) -> Session:
+    return SESSIONS_BY_CONN.get(conn)
+
+
+def get_user_session(username) -> Session:
+    return SESSIONS_BY_USER.get(username)
+
+
+def get_username(conn):
+    session = SESSIONS_BY_CONN.get(conn)
+    if session:
+        return session.username
+    return None
+
+
+def get_conn(username):
+    """
+    Returns: the player's socket, None while the session is suspended
+    """
+    return SESSIONS_BY_USER[username].conn
+
+
+def is_logged_in(username) -> bool:
+    return username in SESSIONS_BY_USER
+
+
+def is_conn_logged_in(conn) -> bool:
+    return conn in SESSIONS_BY_CONN
+
+
+def logged_users():
+    return SESSIONS_BY_USER.keys()
@@ -0,0 +1,74 @@
+import heapq
+import itertools
+import time
+
+
+class Timer:
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerQueue:
+    """
+    Monotonic min-heap of timers run by the event loop. Scheduling is O(log n) and cancelling
+    is O(1): a cancelled timer stays in the heap and is skipped when it reaches the top
+    (the heap is rebuilt once most of it is cancelled timers).
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.cancelled_count = 0
+
+    def call_at(self, deadline, callback, *args) -> Timer:
+        timer = Timer(deadline, callback, args)
+        heapq.heappush(self.heap, (deadline, next(self.counter), timer))
+        return timer
+
+    def call_later(self, delay, callback, *args) -> Timer:
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def cancel(self, timer):
+        if timer and not timer.cancelled:
+            timer.cancel()
+            self.cancelled_count += 1
+            if self.cancelled_count > len(self.heap) // 2:
+                self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+                heapq.heapify(self.heap)
+                self.cancelled_count = 0
+
+    def _drop_cancelled(self):
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+            self.cancelled_count = max(0, self.cancelled_count - 1)
+
+    def get_timeout(self):
+        """
+        Returns: seconds until the next timer is due (0 if one is already due),
+        or None if there are no timers
+        """
+        self._drop_cancelled()
+        if not self.heap:
+            return None
+        return max(0, self.heap[0][0] - time.monotonic())
+
+    def run_due(self):
+        now = time.monotonic()
+        while True:
+            self._drop_cancelled()
+            if not self.heap or self.heap[0][0] > now:
+                return
+            timer = heapq.heappop(self.heap)[2]
+            timer.cancelled = True
+            timer.callback(*timer.args)
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled_count
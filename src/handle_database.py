@@ -63,16 +63,20 @@ def create_new_user(username, password, email):
 
 
 def delete_user(username):
-    if does_username_exist(username):
-        db.delete_user(username)
-        return True
-    return False
+    return db.delete_user(username) == db.COMPLETE
 
 
 def check_password(username, password):
     return hash(password) == db.get_value(username, db.PASSWORD)
 
 
+def get_login_data(username):
+    """
+    Returns: (password hash, elo, games played), or None if the user doesn't exist
+    """
+    return db.get_values(username, [db.PASSWORD, db.ELO, db.GAMES_PLAYED])
+
+
 def does_username_exist(username):
     return db.is_value_in_column(db.USERNAME, username)
 
@@ -104,7 +108,7 @@ def get_email(username):
 
 
 def update_elo(username, new_elo):
-    return db.update_value(username, db.ELO, new_elo)
+    return db.update_value(username, db.ELO, str(new_elo))
 
 
 def get_elo(username):
@@ -112,13 +116,44 @@ def get_elo(username):
 
 
 def update_games_played(username, add):
-    return db.update_value(username, db.GAMES_PLAYED, get_games_played(username) + add)
+    return db.increment_value(username, db.GAMES_PLAYED, add)
 
 
 def get_games_played(username):
     return db.get_value(username, db.GAMES_PLAYED)
 
 
+def get_rating_data(username):
+    """
+    Returns: (elo, games played), or None if the user doesn't exist
+    """
+    return db.get_values(username, [db.ELO, db.GAMES_PLAYED])
+
+
+def settle_games(games):
+    return db.settle_games(games)
+
+
+def get_all_ratings():
+    return db.get_all_ratings()
+
+
+def get_top_players(limit=db.PAGE_SIZE, after=None):
+    return db.get_top_users(limit, after)
+
+
+def get_rank(username):
+    return db.get_rank(username)
+
+
+def get_recent_players(limit=db.PAGE_SIZE, after=None):
+    return db.get_recent_users(limit, after)
+
+
+def get_players_by_permission(permission, limit=db.PAGE_SIZE, after=None):
+    return db.get_users_by_permission(permission, limit, after)
+
+
 def update_entry(username):
     return db.update_entry(username)
 
@@ -140,10 +175,7 @@ def get_creation_date(username):
 
 
 def reset_password(username):
-    if does_username_exist(username):
-        db.update_value(username, db.PASSWORD, hash('default'))
-        return True
-    return False
+    return db.update_value(username, db.PASSWORD, hash('default')) == db.COMPLETE
 
 
 def get_permission(username):
@@ -151,17 +183,11 @@ def get_permission(username):
 
 
 def is_owner(username):
-    if does_username_exist(username):
-        if get_permission(username) == db.OWNER:
-            return True
-    return False
+    return get_permission(username) == db.OWNER
 
 
 def is_admin(username):
-    if does_username_exist(username):
-        if get_permission(username) in [db.ADMIN, db.OWNER]:
-            return True
-    return False
+    return get_permission(username) in [db.ADMIN, db.OWNER]
 
 
 def get_owner_password():
@@ -197,6 +223,6 @@ def test():
     c = db.COLUMNS_L.copy()
     c.remove(db.PASSWORD)
     print(db.printable_table(db.get_all_users(), c))
-    os_values.DB_CONN.close()
+    os_values.close_database_conn()
 if __name__ == '__main__':
     test()
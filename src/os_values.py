@@ -2,8 +2,11 @@ import os
 import sys
 import time
 import timeit
+import threading
+from contextlib import contextmanager
 from platform import uname
 import psycopg2 as pg2
+from psycopg2 import pool as pg2_pool
 from concurrent.futures import ThreadPoolExecutor
 
 CHAIM = 'chaim'
@@ -13,7 +16,12 @@ BAGNO_SERVER = 'bagno_server'
 USERS_l = [CHAIM, ELCHAI, CLOUD_SERVER, BAGNO_SERVER]
 USER = CHAIM
 
-DB_CONN = None
+DB_POOL = None
+DB_MIN_CONNECTIONS = 1
+DB_MAX_CONNECTIONS = 20
+DB_HEALTH_CHECK_INTERVAL = 30  # seconds a pooled connection may sit idle before it is checked on checkout
+DB_LAST_USED = {}  # id of a pooled connection -> monotonic time it was returned to the pool
+DB_LAST_USED_LOCK = threading.Lock()
 
 
 def set_user():
@@ -56,17 +64,81 @@ def get_stockfish_path():
             return r"/usr/local/bin/stockfish"
 
 
-def set_database_conn():
-    global DB_CONN
-    if USER != CHAIM:
-        DB_CONN = db2()
+def get_database_params() -> dict:
     if uname().system == 'Windows' and USER == CHAIM:
-        DB_CONN = pg2.connect(database='chess_users', user='postgres', password=132005)
-    else:
-        connect_str = "dbname='chess_users' user='lasker' host='localhost' password='132005'"
-        DB_CONN = pg2.connect(connect_str)
+        return {'database': 'chess_users', 'user': 'postgres', 'password': 132005}
+    return {'dsn': "dbname='chess_users' user='lasker' host='localhost' password='132005'"}
 
-    DB_CONN.autocommit = True
+
+def set_database_conn():
+    global DB_POOL
+    close_database_conn()
+    DB_POOL = pg2_pool.ThreadedConnectionPool(DB_MIN_CONNECTIONS, DB_MAX_CONNECTIONS, **get_database_params())
+
+
+def close_database_conn():
+    global DB_POOL
+    if DB_POOL and not DB_POOL.closed:
+        DB_POOL.closeall()
+    DB_POOL = None
+    DB_LAST_USED.clear()
+
+
+def is_connection_alive(connection) -> bool:
+    if connection.closed:
+        return False
+    with DB_LAST_USED_LOCK:
+        last_used = DB_LAST_USED.get(id(connection))
+    if last_used is not None and time.monotonic() - last_used < DB_HEALTH_CHECK_INTERVAL:
+        return True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('select 1;')
+        return True
+    except pg2.Error:
+        return False
+
+
+def get_database_conn():
+    """
+    checks a connection out of the pool, a connection that went bad while it was idle is closed
+    and replaced by a new one.
+    """
+    for _ in range(DB_MAX_CONNECTIONS + 1):
+        connection = DB_POOL.getconn()
+        try:
+            # before the ping, so it doesn't open a transaction that blocks set_session
+            connection.autocommit = True
+            alive = is_connection_alive(connection)
+        except BaseException:
+            release_database_conn(connection, broken=True)
+            raise
+        if alive:
+            return connection
+        release_database_conn(connection, broken=True)
+    raise pg2.OperationalError('no working database connection')
+
+
+def release_database_conn(connection, broken=False):
+    with DB_LAST_USED_LOCK:
+        if broken or connection.closed:
+            DB_LAST_USED.pop(id(connection), None)
+        else:
+            DB_LAST_USED[id(connection)] = time.monotonic()
+    DB_POOL.putconn(connection, close=broken or bool(connection.closed))
+
+
+@contextmanager
+def database_conn():
+    connection = get_database_conn()
+    broken = False
+    try:
+        yield connection
+    except (pg2.OperationalError, pg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        release_database_conn(connection, broken)
 
 
 def db2():
@@ -0,0 +1,42 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import chess_matchmaking
+
+
+def make_queue(*players):
+    queue = chess_matchmaking.MatchmakingQueue()
+    for since, (username, rating) in enumerate(players):
+        queue.add(username, rating, now=since)
+    return queue
+
+
+def test_younger_player_of_a_bucket_is_found():
+    queue = make_queue(('old', 1000), ('young', 1049))
+    opponent = queue.find_opponent(1195, chess_matchmaking.BASE_WINDOW, now=1)
+    assert opponent.username == 'young'
+
+
+def test_closest_player_of_a_bucket_wins():
+    queue = make_queue(('far', 1150), ('near', 1500), ('close', 1199))
+    opponent = queue.find_opponent(1300, chess_matchmaking.BASE_WINDOW, now=2)
+    assert opponent.username == 'close'
+
+
+def test_closest_player_across_buckets_wins():
+    queue = make_queue(('below', 1210), ('above', 1345))
+    opponent = queue.find_opponent(1300, chess_matchmaking.BASE_WINDOW, now=1)
+    assert opponent.username == 'above'
+
+
+def test_oldest_player_wins_a_tie():
+    queue = make_queue(('first', 1250), ('second', 1350))
+    opponent = queue.find_opponent(1300, chess_matchmaking.BASE_WINDOW, now=1)
+    assert opponent.username == 'first'
+
+
+def test_no_opponent_out_of_reach():
+    queue = make_queue(('far', 1000))
+    assert queue.find_opponent(1300, chess_matchmaking.BASE_WINDOW, now=0) is None